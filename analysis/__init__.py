@@ -1,5 +1,7 @@
 import datparsing
 import demodulation
+import demodcache
 import phasecalibrator
 import phaseplotter
-import reshaping
\ No newline at end of file
+import reshaping
+import spaceball
\ No newline at end of file
@@ -121,7 +121,9 @@ if __name__ == '__main__':
     # We're being run as a script, which means we want to dump images
     # of blips into image files.
 
-    import optparse, pylab, pyfits, math, os
+    import optparse, pylab, math, os, sys
+    sys.path.append(os.path.join(os.path.dirname(__file__),'..','..'))
+    from cofe_io.fits import read_table
 
     # These are the command-line options, in the form
     #  ((short_spec, long_spec),
@@ -208,9 +210,8 @@ if __name__ == '__main__':
     # The number of digits for blip number in the filenames we make:
     num_digits = int(math.log(options.num_figs, 10))+1
 
-    h = pyfits.open(options.file, memmap=True)
-    channel_data = h[2+options.channel].data['T']
-    signal = channel_data[options.offset:]
+    signal = read_table(options.file, 2+options.channel, ['T'],
+                        slice(options.offset, None))['T']
 
     # The given information regarding first blip position,
     #  blip spacing, and margin of error:
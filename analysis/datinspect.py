@@ -0,0 +1,110 @@
+"""Usage:
+  datinspect.py PATH [PATH ...]
+Prints a health summary of each .dat file given (or of every .dat file in
+each folder given): valid and invalid revolution counts, where the
+revolutions don't come every SAMPLES_PER_REVOLUTION samples, where the
+revolution counter jumps, and how many samples of each channel are
+saturated. The files are read sequentially in large blocks and nothing
+is converted, so this goes about as fast as the disk."""
+
+import os
+import sys
+import glob
+import numpy
+
+import datparsing
+from datparsing import SAMPLES_PER_REVOLUTION, NUM_DATA_CHANNELS,\
+                       ENCODER_START_TRIGGER, dat_dtype, channels_labels
+
+# Samples read per block: 2**20 samples is 42MB.
+BLOCK_SAMPLES = 2**20
+# Counts that mean the ADC was at the end of its range.
+SATURATED_COUNTS = (0, 2**16 - 1)
+
+def inspect_dat( filename, block_samples=BLOCK_SAMPLES ):
+    """Scans a .dat file and returns a dict summarizing its health.
+
+    The keys are:
+     nsamples: number of complete samples in the file.
+     valid_revs, invalid_revs: revolutions with and without exactly
+      SAMPLES_PER_REVOLUTION samples before the next one or the end of
+      the file (see datparsing.rev_start_indices with exact set).
+     first_trigger: offset of the first revolution start, or None.
+     gaps: (offset, length) of every invalid revolution.
+     counter_jumps: (offset, rev before, rev after) wherever consecutive
+      valid revolutions don't have consecutive revolution numbers.
+     saturated: fraction of each channel's samples at SATURATED_COUNTS.
+    """
+    triggers = []
+    trigger_revs = []
+    saturated = numpy.zeros(NUM_DATA_CHANNELS, dtype=numpy.int64)
+    nsamples = 0
+    f = open(filename, 'rb')
+    try:
+        while True:
+            block = numpy.fromfile(f, dtype=dat_dtype, count=block_samples)
+            if len(block) == 0:
+                break
+            block_triggers = numpy.flatnonzero(block['enc'] < ENCODER_START_TRIGGER)
+            triggers.append(block_triggers + nsamples)
+            trigger_revs.append(datparsing.rev_numbers(block[block_triggers]))
+            counts = datparsing.raw_counts(block)[:, :NUM_DATA_CHANNELS]
+            for value in SATURATED_COUNTS:
+                saturated += (counts == value).sum(axis=0)
+            nsamples += len(block)
+    finally:
+        f.close()
+    triggers = numpy.concatenate(triggers) if triggers else numpy.zeros(0, numpy.int64)
+    trigger_revs = numpy.concatenate(trigger_revs) if trigger_revs else triggers
+
+    lengths = numpy.diff(numpy.append(triggers, nsamples))
+    valid = lengths == SAMPLES_PER_REVOLUTION
+    wrong = numpy.flatnonzero(~valid)
+    valid_revs = trigger_revs[valid]
+    jumps = numpy.flatnonzero(numpy.diff(valid_revs) != 1)
+    valid_starts = triggers[valid]
+
+    return {
+        'nsamples' : nsamples,
+        'valid_revs' : int(valid.sum()),
+        'invalid_revs' : int(len(triggers) - valid.sum()),
+        'first_trigger' : int(triggers[0]) if len(triggers) else None,
+        'gaps' : zip(triggers[wrong].tolist(), lengths[wrong].tolist()),
+        'counter_jumps' : zip(valid_starts[jumps+1].tolist(),
+                              valid_revs[jumps].tolist(),
+                              valid_revs[jumps+1].tolist()),
+        'saturated' : saturated / float(max(nsamples, 1)),
+        }
+
+def format_report( filename, summary, max_listed=10 ):
+    """Returns a printable report of an inspect_dat summary."""
+    lines = ["%s: %d samples, %d valid revolutions, %d invalid"
+             %(filename, summary['nsamples'], summary['valid_revs'],
+               summary['invalid_revs'])]
+    if summary['first_trigger'] is None:
+        lines.append("  No revolution starts found.")
+    elif summary['first_trigger'] > 0:
+        lines.append("  %d samples before the first revolution."
+                     %summary['first_trigger'])
+    for key, title in (('gaps', "Revolutions of the wrong length (offset, length)"),
+                       ('counter_jumps', "Counter jumps (offset, before, after)")):
+        items = summary[key]
+        if items:
+            lines.append("  %s: %d" %(title, len(items)))
+            for item in items[:max_listed]:
+                lines.append("    %s" %(item,))
+            if len(items) > max_listed:
+                lines.append("    ...")
+    for ch, fraction in zip(channels_labels, summary['saturated']):
+        if fraction > 0:
+            lines.append("  %s saturated: %.4f%%" %(ch, 100*fraction))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        if os.path.isdir(path):
+            fnames = sorted(glob.glob(os.path.join(path, '*.dat')))
+        else:
+            fnames = [path]
+        for fname in fnames:
+            print format_report(fname, inspect_dat(fname))
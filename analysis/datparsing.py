@@ -7,16 +7,37 @@
 #  iter_valid_revolutions(raw): generates length-1 arrays of rev_dtype,
 #    representing the data gathered during valid revolutions of the
 #    polarization disk.
+#  rev_start_indices(raw): the sample offsets of every valid revolution
+#    in raw, as an integer array, found in one vectorized pass.
+#  read_rev_index(filename): the same offsets for a .dat file, cached in
+#    a small sidecar file (<name>.revidx) so later runs skip the scan.
+#  RevIndex(filename): finds revolutions in a .dat file by revolution
+#    number, returning memmap slices without reading the file through.
+#  SectorProfile(): accumulates the mean value of every channel at every
+#    sample of a revolution, over as many files as you like.
+#  DatCollection(folder): a sorted folder of .dat files read as one long
+#    sequence of samples, with revolutions stitched across files.
+#  DatTail(pattern): follows the newest .dat file matching a glob pattern
+#    while it is being written, yielding revolutions as they complete.
 # We recognize when a new revolution starts by seeing that the encoder
 #  value is less than ENCODER_START_TRIGGER.
 # A "valid" revolution is one with exactly SAMPLES_PER_REVOLUTION samples.
 #  Any other is damaged in some way, and recommended to be ignored.
 
+import os
+import sys
+import glob
 import numpy
 
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+from cofe_io.files import read_npz, write_npz
+
 SAMPLES_PER_REVOLUTION = 256
 NUM_DATA_CHANNELS = 16
 ENCODER_START_TRIGGER = 16
+# The ADC maps -10V..+10V onto the full range of a uint16:
+VOLTS_PER_COUNT = 20./2**16
+VOLTS_OFFSET = -10.
 
 # Names of the data channels:
 channels_labels = ['Channel_%02d' % i for i in range(NUM_DATA_CHANNELS)]
@@ -33,62 +54,412 @@ rev_dtype = numpy.dtype( [('rev',numpy.long)] +\
 def read_raw( filename ):
     return numpy.memmap(filename,dtype=dat_dtype,mode='r')
 
+def raw_counts( raw ):
+    """Returns raw as a (samples x fields) uint16 array, without copying."""
+    return raw.view(numpy.uint16).reshape((-1, len(dat_dtype.names)))
+
+def rev_numbers( rev_starts ):
+    """Decodes the revolution counter of the given samples."""
+    return rev_starts['rev0'].astype(numpy.long) +\
+           rev_starts['rev1'].astype(numpy.long) * SAMPLES_PER_REVOLUTION +\
+           rev_starts['rev2'].astype(numpy.long) * SAMPLES_PER_REVOLUTION**2
+
+def gather_revolutions( raw, starts, samples_per_rev=SAMPLES_PER_REVOLUTION ):
+    """Returns the channel counts of the revolutions at the given offsets.
+
+    The result is a (revolutions x samples_per_rev x channels)
+     uint16 array, copied out of raw with a single fancy index."""
+    offsets = numpy.asarray(starts)[:,None] + numpy.arange(samples_per_rev)
+    return raw_counts(raw)[offsets, :NUM_DATA_CHANNELS]
+
 def valid_raw_to_revs( valid_raw ):
     rev_starts = valid_raw[::SAMPLES_PER_REVOLUTION]
     result = numpy.zeros( len(rev_starts), dtype=rev_dtype )
-    result['rev'] = rev_starts['rev0'].astype(numpy.long) +\
-                    rev_starts['rev1'].astype(numpy.long) * SAMPLES_PER_REVOLUTION +\
-                    rev_starts['rev2'].astype(numpy.long) * SAMPLES_PER_REVOLUTION**2
+    result['rev'] = rev_numbers(rev_starts)
     for ch in channels_labels:
-        voltages = valid_raw[ch] * 20./2**16 - 10
+        voltages = valid_raw[ch] * VOLTS_PER_COUNT + VOLTS_OFFSET
         result[ch] = voltages.reshape((-1, SAMPLES_PER_REVOLUTION))
     return result
 
-def iter_valid_rev_start_indices( raw ):
-    enc = raw['enc']
-    start = 0
-    
-    while start < len(raw):
-        window = enc[start : start+SAMPLES_PER_REVOLUTION]
-        if len(window) < SAMPLES_PER_REVOLUTION:
-            break
-        window_rev_starts, = numpy.where(window < ENCODER_START_TRIGGER)
-        if (len(window_rev_starts) == 1) and (window_rev_starts[0] == 0):
-            yield start
-            start += SAMPLES_PER_REVOLUTION
-        elif len(window_rev_starts) > 0:
-            start += window_rev_starts[-1]
+def rev_start_indices( raw, samples_per_rev=SAMPLES_PER_REVOLUTION, exact=False ):
+    """Returns the offsets of all valid revolutions in raw as an int64 array.
+
+    A revolution starting at trigger t is valid if no other trigger falls
+     in the following samples_per_rev samples and the whole revolution is
+     inside raw. This is exactly the set of offsets that the old windowed
+     scan produced.
+    If exact is set, a revolution is only valid if the next trigger, or
+     the end of raw, comes exactly samples_per_rev samples after t, so
+     overlong revolutions are left out too."""
+    triggers = numpy.flatnonzero(raw['enc'] < ENCODER_START_TRIGGER)
+    if exact:
+        gaps = numpy.diff(numpy.append(triggers, len(raw)))
+        return triggers[gaps == samples_per_rev].astype(numpy.int64)
+    gaps = numpy.diff(numpy.append(triggers, len(raw) + samples_per_rev))
+    valid = (gaps >= samples_per_rev) &\
+            (triggers + samples_per_rev <= len(raw))
+    return triggers[valid].astype(numpy.int64)
+
+def rev_index_filename( filename ):
+    return os.path.splitext(filename)[0] + '.revidx'
+
+def read_rev_index( filename, update=True ):
+    """Returns rev_start_indices for a .dat file, using its sidecar index.
+
+    The index is trusted only if it was built from the same number of
+     samples the file has now. Otherwise the file is rescanned and, if
+     update is True, the sidecar is rewritten."""
+    return load_rev_index(filename, update)[0]
+
+def load_rev_index( filename, update=True ):
+    """Returns (starts, revs) for a .dat file, using its sidecar index.
+
+    starts is as for read_rev_index, and revs holds the revolution number
+     decoded from the rev0/rev1/rev2 counters at each of those starts."""
+    raw = read_raw(filename)
+    index_filename = rev_index_filename(filename)
+    index = read_npz(index_filename, nsamples=len(raw))
+    # Indices written before revs was added are rebuilt too.
+    if index is not None and 'revs' in index:
+        return index['starts'], index['revs']
+    starts = rev_start_indices(raw)
+    revs = rev_numbers(raw[starts])
+    if update:
+        try:
+            write_rev_index(filename, starts, revs, len(raw))
+        except (IOError, OSError):
+            print "Warning: could not write index %s" %index_filename
+    return starts, revs
+
+def write_rev_index( filename, starts, revs, nsamples ):
+    """Writes the sidecar index, under a temporary name until it's complete."""
+    write_npz(rev_index_filename(filename), nsamples=numpy.int64(nsamples),
+              starts=starts, revs=revs)
+
+class RevIndex( object ):
+    """Looks up the valid revolutions of a .dat file by revolution number.
+
+    Built from the file's sidecar index, so it costs one scan of the file
+     the first time and a small read afterwards. The revolution counter
+     may reset partway through a file, so lookups binary-search a sorted
+     copy of it rather than assuming it only goes up.
+
+    Example:
+     index = RevIndex(filename)
+     raw, starts = index.slice(1200000, 1201000)
+     # raw is a memmap view, no data is read until you use it.
+    """
+    def __init__( self, filename ):
+        self.filename = filename
+        self.raw = read_raw(filename)
+        self.starts, self.revs = load_rev_index(filename)
+        self.order = numpy.argsort(self.revs, kind='mergesort')
+        self.sorted_revs = self.revs[self.order]
+
+    def __len__( self ):
+        return len(self.starts)
+
+    def find( self, first, stop ):
+        """Returns the positions in starts of revolutions first <= rev < stop, in file order."""
+        lo, hi = numpy.searchsorted(self.sorted_revs, [first, stop])
+        return numpy.sort(self.order[lo:hi])
+
+    def slice( self, first, stop ):
+        """Returns (raw, starts) for revolutions first <= rev < stop.
+
+        raw is a zero-copy slice of the file's memmap spanning those
+         revolutions, and starts are their offsets within it."""
+        found = self.starts[self.find(first, stop)]
+        if len(found) == 0:
+            return self.raw[0:0], found
+        window = self.raw[found[0] : found[-1] + SAMPLES_PER_REVOLUTION]
+        return window, found - found[0]
+
+class SectorProfile( object ):
+    """Running per-sector sums of all channels, over any number of revolutions.
+
+    Revolutions are added block_revs at a time, so memory use doesn't
+     depend on how much data goes in. The counts are summed exactly as
+     int64, so profiles built in different processes can be merged with
+     += in any order and give the same result."""
+    def __init__( self, samples_per_rev=SAMPLES_PER_REVOLUTION ):
+        self.samples_per_rev = samples_per_rev
+        self.sums = numpy.zeros((NUM_DATA_CHANNELS, samples_per_rev), dtype=numpy.int64)
+        self.count = 0
+
+    def add( self, raw, starts=None, block_revs=1024 ):
+        """Adds the revolutions of raw at the given offsets (all valid ones by default)."""
+        if starts is None:
+            starts = rev_start_indices(raw, self.samples_per_rev)
+        for i in range(0, len(starts), block_revs):
+            block = gather_revolutions(raw, starts[i:i+block_revs], self.samples_per_rev)
+            self.sums += block.sum(axis=0, dtype=numpy.int64).T
+        self.count += len(starts)
+        return self
+
+    def add_file( self, filename ):
+        """Adds every valid revolution in a .dat file."""
+        if self.samples_per_rev == SAMPLES_PER_REVOLUTION:
+            starts = read_rev_index(filename)
         else:
-            start += SAMPLES_PER_REVOLUTION
+            starts = None
+        return self.add(read_raw(filename), starts)
+
+    def __iadd__( self, other ):
+        if other.samples_per_rev != self.samples_per_rev:
+            raise ValueError( "can't merge profiles of different revolution lengths" )
+        self.sums += other.sums
+        self.count += other.count
+        return self
+
+    def mean( self ):
+        """Returns the mean voltage of each channel at each sample of a revolution.
+
+        The result has shape (NUM_DATA_CHANNELS, samples_per_rev).
+         Raises ValueError if no revolutions have been added, since
+         there's nothing to average."""
+        if self.count == 0:
+            raise ValueError( "no revolutions in the profile to average" )
+        return self.sums / float(self.count) * VOLTS_PER_COUNT + VOLTS_OFFSET
+
+def mean_sector_profile( raw, starts=None ):
+    """Returns SectorProfile().add(raw, starts).mean()."""
+    return SectorProfile().add(raw, starts).mean()
+
+def iter_valid_rev_start_indices( raw ):
+    for i in rev_start_indices(raw):
+        yield int(i)
 
 def count_valid_revolutions( raw ):
-    result = 0
-    for i in iter_valid_rev_start_indices(raw):
-        result += 1
-    return result
+    return len(rev_start_indices(raw))
 
 def iter_valid_revolutions( raw ):
     for i in iter_valid_rev_start_indices(raw):
         window = raw[i : i+SAMPLES_PER_REVOLUTION]
         yield valid_raw_to_revs(window)
 
+def iter_rev_windows( raw, block_revs=1024, samples_per_rev=SAMPLES_PER_REVOLUTION ):
+    """Yields (window, starts) for the valid revolutions of raw, a block at a time.
+
+    Each window is a slice of raw long enough for block_revs revolutions,
+     and starts are the offsets in it of the valid revolutions it holds.
+     Consecutive windows overlap by samples_per_rev-1 samples, so a
+     revolution that straddles the end of a window is found, exactly
+     once, in the next one. Every sample is looked at about once.
+     A DatCollection supplies its own windows."""
+    if isinstance(raw, DatCollection):
+        for window in raw.iter_rev_windows(block_revs):
+            yield window
+        return
+    window_size = block_revs * samples_per_rev + samples_per_rev - 1
+    start = 0
+    while start + samples_per_rev <= len(raw):
+        stop = min(start + window_size, len(raw))
+        window = raw[start:stop]
+        starts = rev_start_indices(window, samples_per_rev)
+        if len(starts) > 0:
+            yield window, starts
+        if stop == len(raw):
+            break
+        start = stop - (samples_per_rev - 1)
+
 def iter_chunks( raw, size=20 ):
-    window_size = size*SAMPLES_PER_REVOLUTION
-    enc = raw['enc']
+    """Yields arrays of dat_dtype holding up to size valid revolutions each.
+
+    Only revolutions of exactly SAMPLES_PER_REVOLUTION samples are kept
+     (see rev_start_indices with exact set): unlike in demodulation, an
+     overlong revolution is dropped rather than cut short.
+    raw is read in windows of size+1 revolutions' worth of samples that
+     overlap by one revolution, so each revolution is found, with the
+     sample after it, in exactly one window. The revolutions are copied
+     out back to back with one take per chunk, so every chunk starts with
+     a revolution start. (We take rows of the plain uint16 view: fancy
+     indexing the structured array directly is about ten times slower.)"""
+    sample_offsets = numpy.arange(SAMPLES_PER_REVOLUTION)
+    window_size = (size + 1) * SAMPLES_PER_REVOLUTION
     start = 0
-    print "Intended window size:", window_size
-    while start < len(raw):
-        window = numpy.array(raw[start:start+window_size])
-        window_rev_starts, = numpy.where(window['enc'] < ENCODER_START_TRIGGER)
-        boundaries = [0]+list(window_rev_starts)+[len(window)]
-        boundaries.reverse()
-        for i in range(len(boundaries)-1):
-            b1,b2 = boundaries[i+1], boundaries[i]
-            if b2-b1 != SAMPLES_PER_REVOLUTION:
-                window = numpy.delete(window, numpy.s_[b1:b2])
-        if len(window) > 0:
-            yield window
-        if (len(window_rev_starts) > 0) and (window_rev_starts[0] > 0):
-            start += window_rev_starts[-1]
+    while start + SAMPLES_PER_REVOLUTION <= len(raw):
+        stop = min(start + window_size, len(raw))
+        window = raw[start:stop]
+        starts = rev_start_indices(window, exact=True)
+        if stop < len(raw):
+            # The end of the window isn't a trigger; a revolution ending
+            #  there is checked in the next window instead.
+            starts = starts[starts + SAMPLES_PER_REVOLUTION < len(window)]
+        counts = raw_counts(window)
+        for i in range(0, len(starts), size):
+            rows = (starts[i:i+size,None] + sample_offsets).ravel()
+            yield numpy.take(counts, rows, axis=0).view(dat_dtype).ravel()
+        if stop == len(raw):
+            break
+        start = stop - SAMPLES_PER_REVOLUTION
+
+class DatCollection( object ):
+    """A sorted list of .dat files, read as one long sequence of samples.
+
+    Indexing with an integer or a slice uses offsets into the whole
+     sequence. A slice inside one file is a view of that file's memmap;
+     one that spans files is copied, but only the samples in the slice.
+     Nothing is read until a slice is.
+
+    Revolutions that start at the end of one file and finish at the
+     start of the next are counted like any other: starts and revs hold
+     the global sample offset and revolution number of every valid
+     revolution in the collection, in order.
+
+    A DatCollection can be passed to iter_rev_windows, and so to
+     demodulation.demodulate and demodulate_stream, in place of raw.
+    """
+    def __init__( self, path ):
+        if isinstance(path, basestring):
+            filenames = glob.glob(os.path.join(path, '*.dat'))
         else:
-            start += window_size
+            filenames = path
+        # numpy can't memmap an empty file, and a file that was just
+        #  created may not hold a whole sample yet.
+        self.filenames = sorted(f for f in filenames
+                                if os.path.getsize(f) >= dat_dtype.itemsize)
+        self.raws = [read_raw(f) for f in self.filenames]
+        self.offsets = numpy.cumsum([0] + [len(raw) for raw in self.raws])
+            # self.offsets[i] is the global offset of the first sample of
+            #  file i, and self.offsets[-1] is the total length.
+        self._starts = None
+        self._revs = None
+
+    def __len__( self ):
+        return int(self.offsets[-1])
+
+    def file_index( self, sample ):
+        """Returns the index of the file holding the given global sample."""
+        return int(numpy.searchsorted(self.offsets, sample, side='right')) - 1
+
+    def __getitem__( self, key ):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[start:stop][::step]
+            stop = max(start, stop)
+            if start == stop:
+                return numpy.zeros(0, dtype=dat_dtype)
+            first, last = self.file_index(start), self.file_index(stop - 1)
+            pieces = [self.raws[i][max(start, self.offsets[i]) - self.offsets[i] :
+                                   min(stop, self.offsets[i+1]) - self.offsets[i]]
+                      for i in range(first, last + 1)]
+            if len(pieces) == 1:
+                return pieces[0]
+            return numpy.concatenate(pieces)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError( "sample %d out of range" %key )
+        i = self.file_index(key)
+        return self.raws[i][key - self.offsets[i]]
+
+    @property
+    def starts( self ):
+        if self._starts is None:
+            self._index()
+        return self._starts
+
+    @property
+    def revs( self ):
+        if self._revs is None:
+            self._index()
+        return self._revs
+
+    def _index( self ):
+        """Finds every valid revolution, using each file's sidecar index.
+
+        The sidecars cover the revolutions that fit inside their file; the
+         ones that cross the end of a file are found by scanning the
+         SAMPLES_PER_REVOLUTION-1 samples on either side of it."""
+        spr = SAMPLES_PER_REVOLUTION
+        starts, revs = [], []
+        for i, filename in enumerate(self.filenames):
+            file_starts, file_revs = load_rev_index(filename)
+            starts.append(file_starts + self.offsets[i])
+            revs.append(file_revs)
+            end = self.offsets[i+1]
+            if i + 1 == len(self.filenames) or end == self.offsets[i]:
+                continue
+            region_start = max(self.offsets[i], end - (spr - 1))
+            region = self[region_start : end + spr - 1]
+            region_starts = rev_start_indices(region)
+            region_starts = region_starts[region_starts < end - region_start]
+            starts.append(region_starts + region_start)
+            revs.append(rev_numbers(region[region_starts]))
+        self._starts = numpy.concatenate(starts).astype(numpy.int64) if starts else\
+                       numpy.zeros(0, dtype=numpy.int64)
+        self._revs = numpy.concatenate(revs) if revs else self._starts.copy()
+
+    def iter_rev_windows( self, block_revs=1024 ):
+        """Yields (window, starts) for up to block_revs revolutions at a time.
+
+        Like iter_rev_windows(raw), except that windows don't overlap: each
+         one spans exactly its revolutions."""
+        for i in range(0, len(self.starts), block_revs):
+            block = self.starts[i:i+block_revs]
+            window = self[block[0] : block[-1] + SAMPLES_PER_REVOLUTION]
+            yield window, block - block[0]
+
+class DatTail( object ):
+    """Follows .dat files that are still being written.
+
+    The files matching the glob pattern are taken in sorted order,
+     starting with the newest one. iter_new() maps only the part of the
+     current file that hasn't been looked at yet and yields (raw, starts)
+     pairs, where starts are the offsets in raw of newly completed valid
+     revolutions. When a newer file appears, the rest of the current one
+     is read and the tail moves on to the new file.
+
+    Example:
+     tail = DatTail(os.path.join(root, '*', '*.dat'))
+     while True:
+         for raw, starts in tail.iter_new():
+             ...
+         time.sleep(1)
+    """
+    def __init__( self, pattern, block_revs=1024 ):
+        self.pattern = pattern
+        self.window_size = block_revs * SAMPLES_PER_REVOLUTION +\
+                           SAMPLES_PER_REVOLUTION - 1
+        self.filename = None
+        self.offset = 0
+            # Sample index in self.filename before which every
+            #  revolution has already been yielded.
+
+    def newer_files( self ):
+        """Returns the files matching the pattern that come after ours."""
+        filenames = sorted(glob.glob(self.pattern))
+        if self.filename is None:
+            return filenames[-1:]
+        return [f for f in filenames if f > self.filename]
+
+    def iter_new( self ):
+        """Yields (raw, starts) for the revolutions completed since last time."""
+        while True:
+            newer = self.newer_files()
+            if self.filename is not None:
+                for chunk in self.iter_file():
+                    yield chunk
+            if len(newer) == 0:
+                return
+            self.filename, self.offset = newer[0], 0
+
+    def iter_file( self ):
+        """Yields the new revolutions of the current file, in bounded windows."""
+        try:
+            nsamples = os.path.getsize(self.filename) // dat_dtype.itemsize
+        except OSError:
+            return
+        while self.offset + SAMPLES_PER_REVOLUTION <= nsamples:
+            stop = min(self.offset + self.window_size, nsamples)
+            raw = numpy.memmap(self.filename, dtype=dat_dtype, mode='r',
+                               offset=self.offset * dat_dtype.itemsize,
+                               shape=(stop - self.offset,))
+            starts = rev_start_indices(raw)
+            # Every revolution starting before stop-(SAMPLES_PER_REVOLUTION-1)
+            #  was decided in this window; later ones aren't complete yet.
+            self.offset = stop - (SAMPLES_PER_REVOLUTION - 1)
+            if len(starts) > 0:
+                yield raw, starts
@@ -1,21 +1,69 @@
+"""Usage:
+  demod_fits.py FOLDER
+  demod_fits.py -c FOLDER
+Demodulates every .dat file in FOLDER into a .fits file next to it, using
+one process per core. With -c, writes a single FOLDER.fits holding the
+demodulated data of the whole folder instead."""
+
 import sys
 import os
 import glob
-from demodulation import demodulate_dat
+import multiprocessing
+
+from demodcache import demodulate_dat
+from demodulation import demod_dtype
 
 sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
-from cofe_io import fits
+from cofe_io.fits import FitsWriter, write_fits
+
+def dat_files(folder):
+    return sorted(glob.glob(os.path.join(folder, '*.dat')))
+
+def imap_demodulate(filenames, processes=None):
+    """Yields demodulate_dat(f) for each of the filenames, in order.
+
+    The files are demodulated in parallel by a pool of processes
+     (one per core by default)."""
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(demodulate_dat, filenames):
+            yield result
+    finally:
+        pool.terminate()
+
+def write_demod_fits(fname, data):
+    write_fits(fname, {'DATA': data})
 
-folder = sys.argv[1]
-refs = sorted(glob.glob(os.path.join(folder, '*.dat')))
-n_files = len(refs)
+def demod_fits(folder, processes=None):
+    """Writes <name>.fits next to every <name>.dat in the folder."""
+    refs = dat_files(folder)
+    n_files = len(refs)
+    for n, data in enumerate(imap_demodulate(refs, processes)):
+        print("Processing %d/%d: %s" % (n, n_files, refs[n]))
+        write_demod_fits(refs[n].replace('.dat','.fits'), data)
 
-import pycfitsio
+def demod_concatenate_fits(folder, processes=None):
+    """Demodulates every .dat in the folder into one file, <folder>.fits.
 
-for n, ref in enumerate(refs):
-    print("Processing %d/%d: %s" % (n, n_files, ref))
-    fname = ref.replace('.dat','.fits')
+    Rows are in the sorted order of the .dat filenames, however many
+     processes are used. Each file's rows are written as soon as they're
+     demodulated, so memory use doesn't grow with the folder."""
+    refs = dat_files(folder)
+    if len(refs) == 0:
+        print("No .dat files in %s" % folder)
+        return
+    writer = FitsWriter("%s.fits" % folder.rstrip(os.path.sep))
+    try:
+        writer.start_table('DATA', demod_dtype)
+        for n, data in enumerate(imap_demodulate(refs, processes)):
+            print("Demodulated %d/%d: %s" % (n, len(refs), refs[n]))
+            writer.append(data)
+    finally:
+        writer.close()
 
-    f = pycfitsio.create(fname)
-    f.write_HDU('DATA', demodulate_dat(ref))
-    f.close()
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[0] == '-c':
+        demod_concatenate_fits(args[1])
+    else:
+        demod_fits(args[0])
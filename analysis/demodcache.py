@@ -0,0 +1,110 @@
+# A persistent on-disk cache of demodulated .dat files.
+# demodulate_dat(filename) returns the same thing as
+#  demodulation.demodulate_dat(filename), but the result is also saved as
+#  a .npy file in the cache folder, and later calls just memory-map it.
+#  Either way the result is a read-only memmap of the cached file.
+# The cache is only used if asked for, by setting the COFE_DEMOD_CACHE
+#  environment variable to the cache folder or passing cache_dir;
+#  otherwise demodulate_dat just demodulates.
+# An entry is keyed by the .dat's absolute path, size and modification
+#  time, the Demodulator's phases, demodulation.VERSION and the
+#  demodulation options, so it's never reused after any of those change.
+# The cache is kept under MAX_BYTES by deleting the least recently used
+#  entries. Every hit touches its entry, so the modification times of the
+#  entries are their last-use times.
+
+import os
+import hashlib
+import numpy
+
+import demodulation
+
+CACHE_DIR = os.environ.get('COFE_DEMOD_CACHE')
+MAX_BYTES = 10 * 2**30
+
+def cache_key( filename, demodulator, options ):
+    """Returns the name of the cache entry for demodulating filename."""
+    stat = os.stat(filename)
+    key = repr(( os.path.abspath(filename), stat.st_size, stat.st_mtime,
+                 demodulator.phases, demodulator.samples_per_rev,
+                 demodulation.VERSION, sorted(options.items()) ))
+    return hashlib.sha1(key).hexdigest() + '.npy'
+
+def demodulate_dat( filename, demodulator=None, cache_dir=None, max_bytes=MAX_BYTES,
+                    **options ):
+    """demodulator.demodulate_dat(filename, **options), cached on disk.
+
+    demodulator defaults to demodulation.default_demodulator(). Without
+     a cache_dir or COFE_DEMOD_CACHE, nothing is cached."""
+    demodulator = demodulator or demodulation.default_demodulator()
+    cache_dir = cache_dir or CACHE_DIR
+    if cache_dir is None:
+        return demodulator.demodulate_dat(filename, **options)
+    path = os.path.join(cache_dir, cache_key(filename, demodulator, options))
+    if os.path.exists(path):
+        try:
+            result = numpy.load(path, mmap_mode='r')
+            try:
+                os.utime(path, None)
+            except OSError:
+                # Only the LRU order suffers: the entry was evicted by
+                #  another process since, or belongs to another user.
+                pass
+            return result
+        except (IOError, ValueError):
+            print "Warning: discarding damaged cache entry %s" %path
+    result = demodulator.demodulate_dat(filename, **options)
+    try:
+        store(path, result)
+        # Handed back as a hit would be, so callers can't come to rely
+        #  on writing to it.
+        cached = numpy.load(path, mmap_mode='r')
+        evict(cache_dir, max_bytes)
+        return cached
+    except (IOError, OSError, ValueError) as e:
+        print "Warning: could not cache %s: %s" %(filename, e)
+    result.flags.writeable = False
+    return result
+
+def store( path, data ):
+    """Saves data to path, under a temporary name until it's complete."""
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    tmp_path = '%s.%d.tmp' %(path, os.getpid())
+    f = open(tmp_path, 'wb')
+    try:
+        numpy.save(f, data)
+    finally:
+        f.close()
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.rename(tmp_path, path)
+
+def evict( cache_dir, max_bytes ):
+    """Deletes least recently used entries until the cache fits in max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                # Another process evicted it first.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+    total = sum(size for mtime, size, name in entries)
+    for mtime, size, name in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        total -= size
+
+def clear( cache_dir=None ):
+    cache_dir = cache_dir or CACHE_DIR
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        evict(cache_dir, 0)
@@ -9,6 +9,16 @@
 #    format read from the telescopes' .dat files).
 #  demodulate_dat(filename): reads the data in the given .dat file and
 #    demodulates it into an array of data type demod_dtype.
+#  demodulate_revs(raw, starts): demodulates the revolutions starting at
+#    the given sample offsets of raw, all in one batched matrix multiply.
+#  demodulate_stream(raw, block_revs): walks raw in fixed-size blocks and
+#    yields demod_dtype arrays, so memory use doesn't grow with the file.
+#  demodulate(data, harmonics=True) and friends: also output lock-in
+#    amplitudes at the HARMONICS of the revolution frequency, as
+#    lockin_dtype arrays.
+#  Demodulator(phases): an object with all of the above as methods, using
+#    the phases it was given instead of phases.cfg. The module-level
+#    functions use one built from phases.cfg.
 #
 # Here is a lengthy explanation of what the demodulation process is and
 #  why we do it that way:
@@ -50,6 +60,31 @@
 #  Return an array 49 elements wide:
 #    (revolution number + mean TQU of each channel) for each revolution.
 #
+# In practice all three averages are one matrix product: for each channel
+#  we stack [1, Q square wave, U square wave] / SAMPLES_PER_REVOLUTION into
+#  a (SAMPLES_PER_REVOLUTION x 3) "commutator matrix", and multiply a
+#  (revolutions x SAMPLES_PER_REVOLUTION) block of data by it. We do all
+#  16 channels at once with numpy.matmul, BLOCK_REVS revolutions at a time.
+#
+# Converting counts to volts is affine (volts = counts*a + b), and so is
+#  the demodulation, so with counts=True we skip the conversion: we sum
+#  raw ADC counts times [1,+-1,+-1] and convert the 48 sums per revolution
+#  instead. Each sum has at most 256 terms of magnitude < 2**16, so every
+#  partial sum stays below 2**24 and the float32 matrix product is exact
+#  integer arithmetic. Calibration is then done in float64, so this path
+#  matches the float64 one to rounding error (~1e-15 V).
+# With dtype=numpy.float32 the outputs are rounded once to float32 at
+#  the end. All outputs are within +-10 V, so they differ from the
+#  float64 path by at most half a float32 ulp at 10 V: 2**-21 V, about
+#  5e-7 V, or 0.002 ADC counts.
+#
+# For diagnosing the half-wave plate we can also ask for the cosine and
+#  sine components of each channel at 1, 2 and 4 times the revolution
+#  frequency (HARMONICS), measured from the start of the revolution. These
+#  are just six more columns in every channel's commutator matrix, scaled
+#  so that a signal A*cos(2*pi*h*k/SAMPLES_PER_REVOLUTION) gives C<h> = A.
+#  They aren't +-1, so with counts=True they are summed in float64.
+#
 
 from __future__ import division
 import os
@@ -65,52 +100,218 @@ for ch in datparsing.channels_labels:
     for c in 'TQU':
         channels_labels.append(ch+c)
 demod_dtype = numpy.dtype( [('rev',numpy.float)] + [(ch,numpy.float) for ch in channels_labels] )
+demod32_dtype = numpy.dtype( [('rev',numpy.float32)] + [(ch,numpy.float32) for ch in channels_labels] )
 
-global phases
-phases = ConfigParser.ConfigParser(dict(((ch,'0') for ch in datparsing.channels_labels)))
-def update_phases():
-    """Updates the channel phase calibration data from phases.cfg."""
-    global phases
-    if not os.path.exists('phases.cfg'):
-        print "Warning: no file named 'phases.cfg' found. All phases set to 0."
-    phases.read('phases.cfg')
-update_phases()
+HARMONICS = (1, 2, 4)
+lockin_labels = []
+for ch in datparsing.channels_labels:
+    for c in ['T','Q','U'] + ['%s%d' %(cs,h) for h in HARMONICS for cs in 'CS']:
+        lockin_labels.append(ch+c)
+lockin_dtype = numpy.dtype( [('rev',numpy.float)] + [(ch,numpy.float) for ch in lockin_labels] )
+lockin32_dtype = numpy.dtype( [('rev',numpy.float32)] + [(ch,numpy.float32) for ch in lockin_labels] )
+
+# Bump this whenever a change makes demodulate give different results,
+#  so that cached products (see demodcache.py) are recomputed.
+VERSION = 1
+
+# Number of revolutions demodulated per matrix multiply. Bounds the size
+#  of the float64 temporaries to about 32MB.
+BLOCK_REVS = 1024
+
+class Demodulator( object ):
+    """Demodulates .dat data with a fixed set of channel phases.
+
+    phases gives the phase offset of each channel, either as a sequence
+     of NUM_DATA_CHANNELS integers or as a dict {channel label: phase}
+     (missing channels get 0). The commutator matrices are built once,
+     here, and never changed afterwards, so one Demodulator can be shared
+     freely between threads and pickled to worker processes."""
+    def __init__( self, phases=None, samples_per_rev=datparsing.SAMPLES_PER_REVOLUTION ):
+        if phases is None:
+            phases = [0] * datparsing.NUM_DATA_CHANNELS
+        elif isinstance(phases, dict):
+            phases = [phases.get(ch, 0) for ch in datparsing.channels_labels]
+        if len(phases) != datparsing.NUM_DATA_CHANNELS:
+            raise ValueError( "need one phase per channel, got %d" %len(phases) )
+        self.phases = tuple(int(phase) for phase in phases)
+        self.samples_per_rev = samples_per_rev
+        self.commutators = numpy.array([commutator_matrix(phase, samples_per_rev)
+                                        for phase in self.phases])
+        self.commutators.flags.writeable = False
+        lockin = harmonic_matrix(samples_per_rev)
+        self.lockin_commutators = numpy.concatenate(
+            (self.commutators,
+             numpy.repeat(lockin[None], len(self.phases), axis=0)), axis=2)
+        self.lockin_commutators.flags.writeable = False
+        # Sums of samples_per_rev counts are exact in float32 as long as
+        #  they stay below 2**24 (see the top of the file).
+        if samples_per_rev * 2**16 <= 2**24:
+            self.count_dtype = numpy.float32
+        else:
+            self.count_dtype = numpy.float64
+
+    @classmethod
+    def from_config( cls, filename='phases.cfg', **kwargs ):
+        """Returns a Demodulator using the phases in a phases.cfg file."""
+        config = ConfigParser.ConfigParser(dict(((ch,'0') for ch in datparsing.channels_labels)))
+        if not config.read(filename):
+            print "Warning: no file named '%s' found. All phases set to 0." %filename
+        return cls([config.getint('DEFAULT', ch) for ch in datparsing.channels_labels],
+                   **kwargs)
+
+    def __repr__( self ):
+        return 'Demodulator(phases=%r, samples_per_rev=%r)' %(self.phases, self.samples_per_rev)
+
+    def demodulate_revs( self, raw, starts, counts=False, dtype=numpy.float64,
+                         harmonics=False ):
+        """Demodulates the revolutions of raw starting at the given offsets.
+
+        If counts is True, the raw ADC counts are demodulated and converted to
+         volts afterwards. dtype (float64 or float32) selects demod_dtype or
+         demod32_dtype for the result, or lockin_dtype or lockin32_dtype
+         if harmonics is True."""
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        result = numpy.zeros(len(starts), dtype=output_dtype(dtype, harmonics))
+        if len(starts) == 0:
+            return result
+        spr = self.samples_per_rev
+        block = datparsing.gather_revolutions(raw, starts, spr).transpose(2,0,1)
+        if harmonics:
+            weights, count_dtype = self.lockin_commutators, numpy.float64
+        else:
+            weights, count_dtype = self.commutators, self.count_dtype
+        if counts:
+            signs = (weights * spr).astype(count_dtype)
+            sums = numpy.matmul(numpy.ascontiguousarray(block, dtype=count_dtype), signs)
+            tqu = sums.astype(numpy.float64) * (datparsing.VOLTS_PER_COUNT / spr)
+            tqu += datparsing.VOLTS_OFFSET * weights.sum(axis=1)[:,None,:]
+        else:
+            volts = numpy.ascontiguousarray(block, dtype=numpy.float64)
+            volts *= datparsing.VOLTS_PER_COUNT
+            volts += datparsing.VOLTS_OFFSET
+            tqu = numpy.matmul(volts, weights)
+        result['rev'] = datparsing.rev_numbers(raw[starts])
+        result.view(result.dtype[0]).reshape((len(result), -1))[:,1:] =\
+            tqu.transpose(1,0,2).reshape((len(result), -1))
+        return result
+
+    def demodulate_stream( self, raw, block_revs=BLOCK_REVS, **options ):
+        """Yields demod_dtype arrays of up to block_revs revolutions from raw.
+
+        raw is read one window at a time (see datparsing.iter_rev_windows),
+         so a revolution that straddles the end of a window is demodulated
+         from the next one instead. options are passed on to demodulate_revs."""
+        for window, starts in datparsing.iter_rev_windows(raw, block_revs,
+                                                          self.samples_per_rev):
+            yield self.demodulate_revs(window, starts, **options)
 
+    def demodulate( self, raw, starts=None, **options ):
+        if starts is None:
+            blocks = list(self.demodulate_stream(raw, **options))
+        else:
+            blocks = [self.demodulate_revs(raw, starts[i:i+BLOCK_REVS], **options)
+                      for i in range(0, len(starts), BLOCK_REVS)]
+        if len(blocks) == 0:
+            return self.demodulate_revs(raw, [], **options)
+        return numpy.concatenate(blocks)
 
-def square_wave(phase=0, U=False):
-    """Returns a [+1,-1] square wave with 4 periods over SAMPLES_PER_REVOLUTION points.
+    def demodulate_dat( self, filename, **options ):
+        raw = datparsing.read_raw(filename)
+        if self.samples_per_rev == datparsing.SAMPLES_PER_REVOLUTION:
+            starts = datparsing.read_rev_index(filename)
+        else:
+            starts = datparsing.rev_start_indices(raw, self.samples_per_rev)
+        return self.demodulate(raw, starts=starts, **options)
+
+
+def output_dtype(dtype=numpy.float64, harmonics=False):
+    """Returns the record dtype demodulate produces for the given options."""
+    if harmonics:
+        return lockin32_dtype if dtype == numpy.float32 else lockin_dtype
+    return demod32_dtype if dtype == numpy.float32 else demod_dtype
+
+def square_wave(phase=0, U=False, samples_per_rev=datparsing.SAMPLES_PER_REVOLUTION):
+    """Returns a [+1,-1] square wave with 4 periods over samples_per_rev points.
     
     One of the rising edges is 'phase' data points in. If U==True, the rising edge
      is further offset by a quarter-period."""
     # We have 4 periods because, as explained at the top of the file,
     #  there are four [high,low] periods in each revolution.
     # The width of one flat section of square wave:
-    width = datparsing.SAMPLES_PER_REVOLUTION // 8
+    width = samples_per_rev // 8
     if U:
         phase += width // 2
-    commutator = numpy.array([])
-    for i in range(8):
-        sign = -1 if (i%2) else 1
-        commutator = numpy.concatenate([commutator, sign * numpy.ones(width)])
+    commutator = numpy.tile(numpy.repeat([1., -1.], width), 4)
     return numpy.roll(commutator,phase)
 
+def commutator_matrix(phase=0, samples_per_rev=datparsing.SAMPLES_PER_REVOLUTION):
+    """Returns the (samples_per_rev x 3) T/Q/U weights for one channel.
+
+    Multiplying a revolution's data by this gives its mean T, Q and U."""
+    weights = numpy.empty((samples_per_rev, 3))
+    weights[:,0] = 1
+    weights[:,1] = square_wave(phase=phase, samples_per_rev=samples_per_rev)
+    weights[:,2] = square_wave(phase=phase, U=True, samples_per_rev=samples_per_rev)
+    return weights / samples_per_rev
+
+def harmonic_matrix(samples_per_rev=datparsing.SAMPLES_PER_REVOLUTION):
+    """Returns the (samples_per_rev x 2*len(HARMONICS)) lock-in weights.
+
+    The columns are cos and sin of each harmonic in turn, times 2/samples_per_rev."""
+    angle = 2 * numpy.pi * numpy.arange(samples_per_rev) / samples_per_rev
+    weights = numpy.empty((samples_per_rev, 2 * len(HARMONICS)))
+    for i, h in enumerate(HARMONICS):
+        weights[:,2*i] = numpy.cos(h * angle)
+        weights[:,2*i+1] = numpy.sin(h * angle)
+    return weights * 2 / samples_per_rev
+
+
+# The module-level functions below demodulate with the phases in the
+#  global ConfigParser 'phases', read from phases.cfg in the current
+#  directory. Anything that needs other phases should make its own
+#  Demodulator instead of changing them.
+global phases
+phases = ConfigParser.ConfigParser(dict(((ch,'0') for ch in datparsing.channels_labels)))
+def update_phases():
+    """Updates the channel phase calibration data from phases.cfg."""
+    global phases
+    if not os.path.exists('phases.cfg'):
+        print "Warning: no file named 'phases.cfg' found. All phases set to 0."
+    phases.read('phases.cfg')
+update_phases()
+
+def phase_offsets():
+    """Returns the current phase offset of each channel, as a tuple."""
+    return tuple(phases.getint('DEFAULT', ch) for ch in datparsing.channels_labels)
+
+_demodulators = {}
+def default_demodulator():
+    """Returns the Demodulator for the current phases (built once per phase set)."""
+    key = phase_offsets()
+    demodulator = _demodulators.get(key)
+    if demodulator is None:
+        demodulator = Demodulator(key)
+        _demodulators.clear()
+        _demodulators[key] = demodulator
+    return demodulator
+
+def commutator_matrices():
+    """Returns the stacked commutator matrices of all channels.
+
+    The result has shape (NUM_DATA_CHANNELS x SAMPLES_PER_REVOLUTION x 3)."""
+    return default_demodulator().commutators
+
+def demodulate_revs(raw, starts, **options):
+    return default_demodulator().demodulate_revs(raw, starts, **options)
 
+def demodulate_stream(raw, block_revs=BLOCK_REVS, **options):
+    return default_demodulator().demodulate_stream(raw, block_revs=block_revs, **options)
 
-def demodulate(raw):
-    data = numpy.concatenate(tuple(datparsing.iter_valid_revolutions(raw)))
-    result = numpy.zeros(len(data), dtype=demod_dtype)
-    result['rev'] = data['rev']
-    for ch in datparsing.channels_labels:
-        phase = phases.getint('DEFAULT', ch)
-        q_commutator = square_wave(phase=phase)
-        u_commutator = square_wave(phase=phase, U=True)
-        result[ch+'T'] = numpy.mean(data[ch], axis=1)
-        result[ch+'Q'] = numpy.mean(data[ch]*q_commutator, axis=1)
-        result[ch+'U'] = numpy.mean(data[ch]*u_commutator, axis=1)
-    return result
+def demodulate(raw, starts=None, **options):
+    return default_demodulator().demodulate(raw, starts=starts, **options)
 
-def demodulate_dat(filename):
-    return demodulate(datparsing.read_raw(filename))
+def demodulate_dat(filename, **options):
+    return default_demodulator().demodulate_dat(filename, **options)
 
 
 if __name__ == '__main__':
@@ -1,3 +1,3 @@
 import Release
 import sys
-Release.analysis.phasecalibrator.run(sys.argv[1], map(int,sys.argv[2:]), True)
\ No newline at end of file
+Release.analysis.phasecalibrator.run(sys.argv[1], map(int,sys.argv[2:]))
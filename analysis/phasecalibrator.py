@@ -1,75 +1,84 @@
 from __future__ import absolute_import
 from . import demodulation
-from .datparsing import channels_labels, SAMPLES_PER_REVOLUTION, dat_dtype
+from . import datparsing
+from .datparsing import channels_labels, SAMPLES_PER_REVOLUTION
 from . import phaseplotter
 import sys
-import os
 import ConfigParser
 import numpy
-import pickle
 
 __doc__ = """Usage:
   phasecalculator.py FILENAME [n ...]
-  phasecalculator.py -s FILENAME [n ...]
-Finds the phase offsets to maximize each channel's mean Q or U value
-in the given file. If the -s option is given, the file will be copied
-to FILENAME_short.dat and truncated to the first hundred or so revolutions,
-so the program will run faster. When the optimal phases are determined,
+  phasecalculator.py -r FILENAME [n ...]
+Finds the phase offsets to maximize each channel's mean Q value in the
+given file. The file is read once, to find the mean value of each channel
+at each sample of a revolution; mean Q for every phase offset is then
+computed from that profile at once. If the -r option is given, the best
+phases are also refined to a fraction of a sample (printed only, since
+phases.cfg holds whole samples). When the optimal phases are determined,
 they're written to phases.cfg. Also, mean value as a function of phase is
 plotted for the given chanel numbers (0-15)."""
 
+# The commutator repeats itself four times per revolution, so there are
+#  only this many distinct phase offsets.
+PHASE_PERIOD = SAMPLES_PER_REVOLUTION // 4
+
 def parse_command_line():
     args = sys.argv[1:]
-    if args[0] == '-s':
-        short = True
+    if args[0] == '-r':
+        refine = True
         args = args[1:]
     else:
-        short = False
+        refine = False
     fname, channelnums = args[0], map(int,args[1:])
-    return short, fname, channelnums
-    
-def truncate( filename, revolutions=100 ):
-    shortfilename = filename.replace('.dat', '_short.dat')
-    m_in = numpy.memmap(filename, dtype=dat_dtype)
-    first_data = m_in[:SAMPLES_PER_REVOLUTION*revolutions]
-    m_out = numpy.memmap(shortfilename, dtype=dat_dtype,
-                         mode='w+', shape=first_data.shape)
-    m_out[:] = first_data[:]
-    del m_in
-    del m_out
-    return shortfilename
+    return refine, fname, channelnums
 
-def run( datfilename, channelnums, short=False ):
-    if short:
-        print "Truncating %s..."
-        datfilename = truncate(datfilename)
+def phase_scan( profile ):
+    """Returns the mean Q of each channel for every phase offset.
 
-    phases = ConfigParser.ConfigParser()
-    channel_phase_info = dict(( (channel,{}) for channel in channels_labels ))
+    profile is a (channels x SAMPLES_PER_REVOLUTION) array of mean
+     sector values. Mean Q at phase p is the mean of profile times
+     square_wave(p), so all SAMPLES_PER_REVOLUTION offsets together are
+     the circular cross-correlation of the profile with square_wave(0),
+     which we get from one FFT."""
+    commutator = demodulation.square_wave(phase=0)
+    spectrum = numpy.fft.rfft(profile, axis=1) *\
+               numpy.conj(numpy.fft.rfft(commutator))
+    return numpy.fft.irfft(spectrum, n=SAMPLES_PER_REVOLUTION, axis=1) /\
+           SAMPLES_PER_REVOLUTION
+
+def refine_phase( scan, phase ):
+    """Returns the peak of a parabola through scan[phase] and its neighbours."""
+    left, mid, right = scan[[phase-1, phase, (phase+1) % len(scan)]]
+    curvature = left - 2*mid + right
+    if curvature >= 0:
+        return float(phase)
+    return phase + 0.5 * (left - right) / curvature
 
-    for phase_offset in range(64):
-        print "Updating phases.cfg..."
-        for channel in channels_labels:
-            phases.set('DEFAULT', channel, str(phase_offset))
-        phases.write(open('phases.cfg','wb'))
-        demodulation.update_phases()
-        
-        print "Demodulating with phase %d..." %phase_offset
-        data = demodulation.demodulate_dat(datfilename)
-            
-        print "Finding mean Q for each channel..."
-        for channel in channels_labels:
-            mean = sum(data[channel+'Q']) / len(data[channel+'Q'])
-            channel_phase_info[channel][phase_offset] = mean
+def run( datfilename, channelnums, refine=False ):
+    print "Finding mean sector profile of %s..." %datfilename
+    raw = datparsing.read_raw(datfilename)
+    profile = datparsing.mean_sector_profile(raw,
+                                             datparsing.read_rev_index(datfilename))
+    scan = phase_scan(profile)
 
-    print "\nCompleted demodulation/averaging loop."
-    for channel, phase_info in channel_phase_info.iteritems():
-        best_phase, max_mean = max(phase_info.iteritems(), key=(lambda pm: pm[1]))
-        print "Channel %s attained maximum %f at phase %d." %(channel,max_mean,best_phase)
+    phases = ConfigParser.ConfigParser()
+    channel_phase_info = {}
+    for i, channel in enumerate(channels_labels):
+        channel_scan = scan[i, :PHASE_PERIOD]
+        channel_phase_info[channel] = dict(enumerate(channel_scan))
+        best_phase = int(channel_scan.argmax())
+        print "Channel %s attained maximum %f at phase %d." %(channel,channel_scan[best_phase],best_phase)
+        if refine:
+            print "  Refined phase: %.2f" %(refine_phase(scan[i], best_phase) % PHASE_PERIOD)
         phases.set( 'DEFAULT', channel, str(best_phase) )
+
+    print "Writing phases.cfg..."
+    phases.write(open('phases.cfg','wb'))
+    demodulation.update_phases()
     phaseplotter.plot(channel_phase_info, channelnums)
 
 if __name__ == '__main__':
     print "Running as main."
-    short, fname, channelnums = parse_command_line()
-    run(fname, channelnums, short=short)
\ No newline at end of file
+    refine, fname, channelnums = parse_command_line()
+    run(fname, channelnums, refine=refine)
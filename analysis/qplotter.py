@@ -8,9 +8,9 @@ import glob
 fnames = sorted(glob.glob(os.path.join(sys.argv[1],'*.dat')))
 channel = 'Channel_%02dQ' %int(sys.argv[2])
 
-data = numpy.zeros(0, dtype=Release.analysis.demodulation.demod_dtype)
-for f in fnames:
-    data = numpy.concatenate((data,Release.analysis.demodulation.demodulate_dat(f)))
+demodcache = Release.analysis.demodcache
+data = numpy.concatenate([demodcache.demodulate_dat(f)[['rev',channel]].copy()
+                          for f in fnames])
 
 starts = range(0,len(data),25)
 avg = numpy.zeros(len(starts), dtype=data.dtype)
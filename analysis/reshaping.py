@@ -1,27 +1,44 @@
 #!/usr/bin/env python
 #
 # This code converts .spaceball files into pretty .fits files.
-#  The initial spaceball-to-fits conversion is done by a .exe
-#  that lives somewhere else, but the .fits it produces are
-#  super-ugly.
-# This code provides the ability to read the super-ugly files
-#  produced by Spaceball2FITS.exe and separates the data by
-#  device into the extensions of a file named
-#  <original_base>_ext.fits.
+#  .spaceball files are decoded directly (see spaceball.py) and
+#  their data separated by device into the extensions of a file
+#  named <original_base>_ext.fits, in one pass.
+# This code can also read the super-ugly .fit files produced by
+#  the old Spaceball2FITS.exe route and reshape them the same way.
+#  The .exe is still used for .spaceball files that don't match
+#  the telemetry layout, or don't decode to sensible clocks (see
+#  spaceball.check_records), on Windows, where it can run.
 # So we end up with .fits files that have extensions named
 #  things like "GYRO", "MAGNETOMETER", etc.
 #
 
 import subprocess
 import os
+import sys
+import functools
+import multiprocessing
 import pyfits
 import glob
 import numpy
 
+import spaceball
+
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+from cofe_io.files import temporary_filename, replace, FileLock
+from cofe_io.fits import FitsWriter, TableLayout
+
 SPACEBALL2FITS_EXE = os.path.join(os.path.dirname(__file__),
                                   'Spaceball2FITS',
                                   'Spaceball2FITS.exe')
 
+# The primary header keyword of an _ext.fits giving how many records of
+#  its source it holds, so that records added later can be appended.
+SOURCE_RECORDS = 'SRCRECS'
+# Device tables rewritten by update_spaceball get room for as many rows
+#  again as they hold, and at least this many.
+MIN_SPARE_ROWS = 1024
+
 # We identify which device a set of data belongs to using
 #  the number of fields.
 device_names = {
@@ -47,6 +64,10 @@ telescope_freqs = {
         5 : '10GHz',
         6 : '15GHz'
         }
+indexed_devices = {
+        'RevCounter' : revcounter_freqs,
+        'Telescope' : telescope_freqs
+        }
 
 def pairwise(sequence):
     """s -> (s0,s1), (s1,s2), (s2, s3), ..., (s[-2],s[-1])"""
@@ -54,19 +75,25 @@ def pairwise(sequence):
         yield sequence[i], sequence[i+1]
 
 def reshaped_filename(filename):
-    return filename.replace('.fit','_ext.fits')
+    return filename.rpartition('.')[0] + '_ext.fits'
 
 def is_converted(filename):
-    if filename.endswith('.spaceball'):
-        return os.path.exists(filename.replace('.spaceball','_ext.fits'))
-    elif filename.endswith('fit'):
-        return os.path.exists(filename.replace('.fit','_ext.fits'))
+    """Returns whether a .spaceball or .fit has an up-to-date _ext.fits.
+
+    _ext.fits files only appear once complete (see reshape_data), so one
+     that is newer than its source is up to date."""
+    if filename.endswith('.spaceball') or filename.endswith('.fit'):
+        ext_filename = reshaped_filename(filename)
+        return os.path.exists(ext_filename) and\
+               os.path.getmtime(ext_filename) > os.path.getmtime(filename)
     else:
         return True
 
-def separate_data( data ):
+def device_layout( colnames ):
+    """Returns (device name, field slice) for each device in a table's columns.
+
+    RevCounters and Telescopes aren't told apart here; see device_index_name."""
     result = []
-    colnames = data.dtype.names
     boundaries = [i for i,colname in enumerate(colnames) if colname.endswith('computerClock')]
     boundaries.append(len(colnames))
     for start,end in pairwise(boundaries):
@@ -74,48 +101,241 @@ def separate_data( data ):
         if number_of_fields not in device_names.iterkeys():
             print "Warning: a device is providing %d fields, an unrecognized number." %number_of_fields
         device_name = device_names.get(number_of_fields, 'Device%d-%d' %(start,end))
-        if device_name == 'RevCounter':
-            try:
-                index_field = data.field(start+1)
-                revcounter_index = index_field[ numpy.nonzero(index_field)[0][0] ]
-                freq = revcounter_freqs.get(revcounter_index, '%d-%d' %(start,end))
-                device_name = device_name + '_' + freq
-            except IndexError:
-                print('RevCounter with index %d is probably OFF, REMOVED from the fits file' %start)
-                continue
-        elif device_name == 'Telescope':
-            try:
-                index_field = data.field(start+1)
-                telescope_index = index_field[ numpy.nonzero(index_field)[0][0] ]
-                freq = telescope_freqs.get(telescope_index, '%d-%d' %(start,end))
-                device_name = device_name + '_' + freq
-            except exceptions.IndexError:
-                print('Telescope with index %d is probably OFF,'
-                       ' REMOVED from the fits file' % start)
-                continue
         result.append((device_name, slice(start,end)))
+    return result
+
+def device_index_name( device_name, index_field, range ):
+    """Returns the name of a RevCounter or Telescope with its frequency appended.
+
+    Returns None if index_field is never set, meaning the device was off."""
+    freqs = indexed_devices[device_name]
+    nonzero = numpy.flatnonzero(index_field)
+    if len(nonzero) == 0:
+        return None
+    index = index_field[nonzero[0]]
+    return device_name + '_' + freqs.get(index, '%d-%d' %(range.start,range.stop))
+
+def separate_data( data ):
+    result = []
+    for device_name, range in device_layout(data.dtype.names):
+        if device_name in indexed_devices:
+            name = device_index_name(device_name, data.field(range.start+1), range)
+            if name is None:
+                print('%s with index %d is probably OFF,'
+                      ' REMOVED from the fits file' %(device_name, range.start))
+                continue
+            device_name = name
+        result.append((device_name, range))
 
     return result
 
+class ReshapePlan(object):
+    """The split of the records of one layout into device tables.
+
+    The fields of a device sit side by side in each record, so a device's
+     table is a view of the records through a dtype covering just those
+     bytes. The only copies made are the one dropping the rows in which
+     the device had no data and, for little-endian records like those of
+     .spaceball files, the byte swap FITS needs anyway.
+    A plan is worked out once per layout (see reshape_plan) and reused for
+     every file with that layout. Which RevCounters and Telescopes are
+     which, and whether they're on, is worked out again for each file.
+    A table can be written with room to grow: spare bytes after its rows,
+     which FITS counts as the table's (unused) heap through PCOUNT. Rows
+     appended later go into that room, taking bytes from PCOUNT, so the
+     extensions after it don't move (see append_data)."""
+    def __init__( self, dtype ):
+        self.devices = []
+        for device_name, range in device_layout(dtype.names):
+            names = dtype.names[range]
+            fields = [dtype.fields[name][:2] for name in names]
+            base = min(offset for format, offset in fields)
+            end = max(offset + format.itemsize for format, offset in fields)
+            colnames = [name.partition('_')[2].replace(' ','_') for name in names]
+            device_dtype = numpy.dtype({
+                'names' : colnames,
+                'formats' : [format for format, offset in fields],
+                'offsets' : [offset - base for format, offset in fields],
+                'itemsize' : end - base })
+            fits_dtype = numpy.dtype([(colname, format.newbyteorder('>'))
+                                      for colname, (format, offset)
+                                      in zip(colnames, fields)])
+            self.devices.append((device_name, range, base, device_dtype, fits_dtype))
+        self.primary = pyfits.PrimaryHDU().header
+
+    def split( self, data ):
+        """Yields (device name, record array of its rows with data) per device."""
+        records = numpy.ascontiguousarray(data.view(numpy.ndarray))
+        for device_name, range, base, device_dtype, fits_dtype in self.devices:
+            if len(records):
+                table = numpy.ndarray(len(records), dtype=device_dtype,
+                                      buffer=records, offset=base,
+                                      strides=records.strides)
+            else:
+                table = numpy.zeros(0, dtype=device_dtype)
+            if device_name in indexed_devices:
+                name = device_index_name(device_name,
+                                         table[device_dtype.names[1]], range)
+                if name is None:
+                    print('%s with index %d is probably OFF,'
+                          ' REMOVED from the fits file' %(device_name, range.start))
+                    continue
+                device_name = name
+            keep = table[device_dtype.names[0]] != 0
+            if not keep.all():
+                table = table[keep]
+            if table.dtype != fits_dtype:
+                table = table.astype(fits_dtype)
+            yield device_name, table
+
+    def write( self, data, filename, spare=False ):
+        """Writes the device tables of data as the extensions of a FITS file.
+
+        If spare is set, each table gets room to grow by as many rows again
+         (at least MIN_SPARE_ROWS)."""
+        self.primary[SOURCE_RECORDS] = len(data)
+        writer = FitsWriter(filename, self.primary)
+        try:
+            for name, table in self.split(data):
+                print(name)
+                if spare:
+                    spare_bytes = max(len(table), MIN_SPARE_ROWS) * table.itemsize
+                else:
+                    spare_bytes = 0
+                writer.start_table(name.upper(), table.dtype, spare_bytes)
+                writer.append(table)
+        finally:
+            writer.close()
+
+# ReshapePlans by record dtype.
+_plans = {}
+
+def reshape_plan( dtype ):
+    """Returns the ReshapePlan of a record dtype, making it the first time."""
+    if dtype not in _plans:
+        _plans[dtype] = ReshapePlan(dtype)
+    return _plans[dtype]
+
+def reshape_data( data, filename, spare=False ):
+    """Splits a table holding every device's columns into one table per device.
+
+    data is a record array whose field names look like <prefix>_<channel>.
+     Writes a FITS file with an extension per device, without the rows in
+     which that device had no data (its computerClock is zero).
+    The file is written under a temporary name and renamed when complete,
+     so readers never see part of one. See ReshapePlan.write for spare."""
+    tmp_filename = temporary_filename(filename)
+    try:
+        reshape_plan(data.dtype).write(data, tmp_filename, spare)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    replace(tmp_filename, filename)
+
+def append_data( data, filename ):
+    """Appends the records of data that filename doesn't hold yet to it.
+
+    filename must have been written by reshape_data from the first records
+     of data. The new rows of each device go into the room left after its
+     table, the table headers are updated, and the count of records held
+     is updated last. So a reader may find some tables grown before the
+     count is, but never a header counting rows that aren't written yet.
+    The file is changed in place, so the caller must hold its FileLock
+     (as update_spaceball does), or two writers could interleave.
+    Returns False, leaving the file alone, if filename doesn't hold the
+     start of data or a device's table is missing or out of room."""
+    writes = []
+    hdus = pyfits.open(filename)
+    try:
+        done = hdus[0].header.get(SOURCE_RECORDS)
+        if done is None or done > len(data):
+            return False
+        if done == len(data):
+            return True
+        extensions = dict((hdu.name, i) for i,hdu in enumerate(hdus) if i > 0)
+        for name, table in reshape_plan(data.dtype).split(data[done:]):
+            if len(table) == 0:
+                continue
+            if name.upper() not in extensions:
+                return False
+            i = extensions[name.upper()]
+            rows = TableLayout(table.dtype).records(table)
+            header = hdus[i].header.copy()
+            info = hdus.fileinfo(i)
+            if header['NAXIS1'] != rows.itemsize or header['PCOUNT'] < rows.nbytes:
+                return False
+            end = info['datLoc'] + header['NAXIS1'] * header['NAXIS2']
+            header['NAXIS2'] += len(rows)
+            header['PCOUNT'] -= rows.nbytes
+            header_string = header.tostring()
+            if len(header_string) != info['datLoc'] - info['hdrLoc']:
+                return False
+            writes.append((end, rows))
+            writes.append((info['hdrLoc'], header_string))
+        primary = hdus[0].header.copy()
+        primary[SOURCE_RECORDS] = len(data)
+        primary_string = primary.tostring()
+        if len(primary_string) != hdus.fileinfo(0)['datLoc']:
+            return False
+        writes.append((0, primary_string))
+    finally:
+        hdus.close()
+
+    f = open(filename, 'r+b')
+    try:
+        for offset, item in writes:
+            f.seek(offset)
+            if isinstance(item, str):
+                f.write(item)
+            else:
+                item.tofile(f)
+    finally:
+        f.close()
+    return True
+
 def reshape_fits( filename ):
     extension = pyfits.open(filename, ignore_missing_end=True)[1]
-    newfile = pyfits.HDUList()
-    for name,range in separate_data(extension.data):
-        print(name)
-        new_columns = []
-        for col in extension.columns[range]:
-            new_name = col.name.partition('_')[2]
-            new_name = new_name.replace(' ','_')
-            new_column = pyfits.Column( name=new_name,
-                                        format=col.format,
-                                        array=col.array )
-            new_columns.append(new_column)
-        newext = pyfits.new_table(new_columns)
-        newext.data = purge_zeros(newext.data)
-        newext.name = name
-        newfile.append(newext)
-    newfilename = filename.replace('.fit', '_ext.fits')
-    newfile.writeto(newfilename, clobber=True)
+    reshape_data(extension.data, reshaped_filename(filename))
+
+def update_spaceball( filename, layout=None, clobber=False, growing=False ):
+    """Brings <name>_ext.fits up to date with <name>.spaceball.
+
+    Only the records added since the last conversion are decoded, and they
+     are appended in place (see append_data). If they don't fit, there's
+     no _ext.fits yet, or clobber is set, the whole file is reshaped with
+     room to grow, so a file that keeps growing is rewritten only each
+     time its size doubles. The _ext.fits is locked (see FileLock) while
+     it's written, so only one process or thread updates it at a time.
+    Set growing if the .spaceball may still be being written: a record
+     cut off at its end is then left for next time, and so is a file of
+     fewer than two records, which check_records can't tell much about.
+    Raises ValueError if the file isn't a whole number of records (unless
+     growing), has fewer than two, or the new records (with the last one
+     converted before them) fail spaceball.check_records."""
+    data = spaceball.read_spaceball(filename, layout, partial=growing, check=False)
+    if len(data) < 2:
+        if growing:
+            return
+        raise ValueError("{0} holds {1} records; too few to check their layout"
+                         .format(filename, len(data)))
+    ext_filename = reshaped_filename(filename)
+    lock = FileLock(ext_filename)
+    lock.acquire()
+    try:
+        # Only the records not converted yet need checking, along with the
+        #  last one that was, to see that the clocks carry on from there.
+        done = 0
+        if not clobber and os.path.exists(ext_filename):
+            done = pyfits.getheader(ext_filename, 0).get(SOURCE_RECORDS, 0)
+        if done > len(data):
+            done = 0
+        spaceball.check_records(data[max(done-1, 0):])
+        if clobber or not (os.path.exists(ext_filename) and
+                           append_data(data, ext_filename)):
+            reshape_data(data, ext_filename, spare=True)
+    finally:
+        lock.release()
 
 def convert_spaceball(filename):
     """Converts <name>.spaceball to <name>.fit.
@@ -136,27 +356,49 @@ def convert_spaceball(filename):
         return False
     return True
 
-def convert_file(filename, clobber=False):
-    """Converts a .spaceball or .fit into a _ext.fits."""
+def convert_file(filename, clobber=False, growing=False):
+    """Converts a .spaceball or .fit into a _ext.fits.
+
+    Does nothing if the _ext.fits is up to date, unless clobber is set.
+     If a .spaceball has grown since its _ext.fits was written, only the
+     new records are converted (see update_spaceball). Set growing for a
+     .spaceball that may still be being written, to convert it up to its
+     last whole record."""
     base = filename.rpartition('.')[0]
     if not os.path.exists(filename):
         raise ValueError("{0} does not exist.".format(filename))
         
     if filename.endswith('.spaceball'):
-        if clobber or not os.path.exists(base+'.fit'):
-            success = convert_spaceball(filename)
-            if success:
-                convert_file(base+'.fit')
+        if clobber or not is_converted(filename):
+            try:
+                update_spaceball(filename, clobber=clobber, growing=growing)
+            except ValueError as e:
+                print "Can't decode {0} natively: {1}".format(filename, e)
+                if os.name != 'nt':
+                    return
+                success = convert_spaceball(filename)
+                if success:
+                    convert_file(base+'.fit', clobber=clobber)
     elif filename.endswith('.fit'):
-        if clobber or not os.path.exists(base+'_ext.fits'):
+        if clobber or not is_converted(filename):
             reshape_fits(filename)
 
-def convert_folder(folder, clobber=False):
-    """Calls convert_file on every .spaceball or .fit in the folder."""
+def convert_folder(folder, clobber=False, processes=None):
+    """Calls convert_file on every .spaceball or .fit in the folder.
+
+    The files are converted in parallel by a pool of processes (one per
+     core by default). Files with an up-to-date _ext.fits are skipped
+     unless clobber is set."""
     spaceballs = glob.glob(os.path.join(folder,'*.spaceball'))
     fits = glob.glob(os.path.join(folder,'*.fit'))
-    for f in spaceballs+fits:
-        convert_file(f, clobber=clobber)
+    files = [f for f in sorted(spaceballs+fits) if clobber or not is_converted(f)]
+    if len(files) == 0:
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        pool.map(functools.partial(convert_file, clobber=clobber), files)
+    finally:
+        pool.terminate()
 
 def purge_zeros(data):
     return data[data.field(0) != 0]
@@ -2,17 +2,26 @@ from __future__ import absolute_import
 from . import datparsing
 import numpy
 import pylab
+import glob
+import os
 import sys
 
 colors = 'rgbck'
-    
+
+def profile_of(path):
+    """Returns the SectorProfile of a .dat file, or of every .dat in a folder."""
+    if os.path.isdir(path):
+        fnames = sorted(glob.glob(os.path.join(path, '*.dat')))
+    else:
+        fnames = [path]
+    profile = datparsing.SectorProfile()
+    for fname in fnames:
+        print "Reading %s" %fname
+        profile.add_file(fname)
+    return profile
+
 def run(fname, channelnums):
-    raw = datparsing.read_raw(fname)
-    data = numpy.concatenate(tuple(datparsing.iter_valid_revolutions(raw)))
-    means = numpy.zeros(1, dtype=datparsing.rev_dtype)[0]
-    for ch in datparsing.channels_labels:
-        #print means[ch].shape, data[ch].mean(axis=0).shape, data[ch].mean(axis=1).shape
-        means[ch] = data[ch].mean(axis=0)
+    means = profile_of(fname).mean()
 
     sectors = pylab.arange(0,4096,4096//256)
 
@@ -21,9 +30,7 @@ def run(fname, channelnums):
     pylab.figure()
     for channelnum in channelnums:
         channel = datparsing.channels_labels[channelnum]
-        print means[channel][0]
-        print sectors
-        pylab.plot(sectors,means[channel][0],c=colors[style_i%len(colors)], label=channel)
+        pylab.plot(sectors,means[channelnum],c=colors[style_i%len(colors)], label=channel)
         style_i += 1
 
     pylab.legend()
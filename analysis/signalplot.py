@@ -9,11 +9,15 @@
 #  If that is still the case, throw a "-i" in there too, to plot against
 #  data-point index rather than interpolated time.
 
+import os
+import sys
 import pylab
 import numpy
-import pyfits
 import optparse
 
+sys.path.append(os.path.join(os.path.dirname(__file__),'..'))
+from cofe_io.fits import read_table
+
 parser = optparse.OptionParser()
 parser.add_option( '-c', '--channel', action='store',
                    dest='channel', type='int', default=1,
@@ -38,10 +42,9 @@ options,args = parser.parse_args()
 if len(args) != 1:
     raise RuntimeError("target filename must be provided")
 
-h = pyfits.open(args[0],
-                memmap=True)
-time = h[1].data['UT'][options.offset:]
-signal = h[2+options.channel].data[options.TQU][options.offset:]
+rows = slice(options.offset, None)
+time = read_table(args[0], 1, ['UT'], rows)['UT']
+signal = read_table(args[0], 2+options.channel, [options.TQU], rows)[options.TQU]
 
 if options.square:
     signal = (signal-numpy.median(signal))**2
@@ -0,0 +1,115 @@
+# Reads .spaceball files, the raw telemetry records written by the flight
+#  computer, directly into numpy, without going through Spaceball2FITS.exe.
+#
+# The layout of a record comes from a telemetry configuration file like
+#  flight/telemetryExampleConfig.txt, which lists the devices in the
+#  telemetry block in order, each as
+#   [GUID] [channel count] ; comment
+#       [channel name]
+#       ...
+#  (the one-line form used by flight/telemetrySend.cfg,
+#   [device name] [GUID] [channel count] [channel name] ...,
+#  is read too). Every record holds every channel of every device in that
+#  order, each as a CHANNEL_DTYPE. A device that had no new data when the
+#  record was written has its computerClock left at zero.
+#
+# The important things here are:
+#  read_layout(filename): the list of (GUID, channel names) blocks.
+#  record_dtype(layout): the numpy dtype of one record. Field names are
+#    B<block number>_<channel name>, the same <device>_<channel> shape as
+#    the columns of the .fit files Spaceball2FITS.exe writes, so
+#    reshaping.reshape_data handles either.
+#  read_spaceball(filename): a memory-mapped recarray of the file's records.
+#  check_records(data): raises ValueError unless the records decoded look
+#    like telemetry. The file's size is the only other check that the
+#    layout (and the headerless, little-endian float64 format) is right,
+#    so read_spaceball does this too, and callers that get a ValueError
+#    should fall back on Spaceball2FITS.exe.
+
+import os
+import re
+import numpy
+
+TELEMETRY_CONFIG = os.path.join(os.path.dirname(__file__), '..', 'flight',
+                                'telemetryExampleConfig.txt')
+CHANNEL_DTYPE = numpy.dtype('<f8')
+
+_bracketed = re.compile(r'\[([^\]]*)\]')
+_guid = re.compile(r'^[0-9A-Fa-f]{8}(-[0-9A-Fa-f]{4}){3}-[0-9A-Fa-f]{12}$')
+
+def read_layout( filename=TELEMETRY_CONFIG ):
+    """Returns the device blocks of a telemetry config as [(GUID, channel names)].
+
+    Raises ValueError if a device's channel count doesn't match the
+     number of channels listed, or its first channel isn't computerClock."""
+    blocks = []
+    for line in open(filename):
+        line = line.split(';')[0]
+        fields = _bracketed.findall(line)
+        guids = [i for i,field in enumerate(fields) if _guid.match(field)]
+        if guids:
+            i = guids[0]
+            blocks.append((fields[i], int(fields[i+1]), list(fields[i+2:])))
+        elif fields and blocks and line[:1].isspace():
+            blocks[-1][2].extend(fields)
+    for guid, count, channels in blocks:
+        if len(channels) != count:
+            raise ValueError( "device %s lists %d channels, expected %d"
+                              %(guid, len(channels), count) )
+        if channels[0] != 'computerClock':
+            raise ValueError( "device %s doesn't start with computerClock" %guid )
+    return [(guid, tuple(channels)) for guid, count, channels in blocks]
+
+def record_dtype( layout ):
+    """Returns the numpy dtype of a record with the given layout.
+
+    A channel name repeated within a device gets its position appended,
+     since numpy and FITS both need unique column names."""
+    fields = []
+    for block, (guid, channels) in enumerate(layout):
+        seen = set()
+        for i, channel in enumerate(channels):
+            name = channel if channel not in seen else '%s_%d' %(channel, i)
+            seen.add(channel)
+            fields.append(('B%d_%s' %(block, name), CHANNEL_DTYPE))
+    return numpy.dtype(fields)
+
+def check_records( data ):
+    """Raises ValueError if any device's computerClock in data is not a
+     finite, non-negative number that never goes backwards.
+
+    Records in which a device had no data (computerClock of zero) are
+     skipped. Anything decoded with the wrong layout or byte order is
+     very unlikely to pass."""
+    for name in data.dtype.names:
+        if name.endswith('_computerClock'):
+            clock = numpy.asarray(data[name])
+            clock = clock[clock != 0]
+            if not (numpy.isfinite(clock).all() and (clock >= 0).all() and
+                    (numpy.diff(clock) >= 0).all()):
+                raise ValueError( "%s doesn't count up; the records aren't "
+                                  "in the expected layout" %name )
+
+def read_spaceball( filename, layout=None, partial=False, check=True ):
+    """Returns a read-only numpy.recarray view of the records in a .spaceball.
+
+    Raises ValueError if the file isn't a whole number of records, which
+     means the layout doesn't match the file, unless partial is set. Then
+     a record still being written at the end of the file is left out.
+    Also raises ValueError if the records fail check_records, unless check
+     is False (which saves reading the whole file)."""
+    if layout is None:
+        layout = read_layout()
+    dtype = record_dtype(layout)
+    size = os.path.getsize(filename)
+    if size % dtype.itemsize != 0 and not partial:
+        raise ValueError( "%s is %d bytes, not a multiple of the %d-byte record"
+                          %(filename, size, dtype.itemsize) )
+    nrecords = size // dtype.itemsize
+    if nrecords == 0:
+        return numpy.zeros(0, dtype=dtype).view(numpy.recarray)
+    data = numpy.memmap(filename, dtype=dtype, mode='r',
+                        shape=(nrecords,)).view(numpy.recarray)
+    if check:
+        check_records(data)
+    return data
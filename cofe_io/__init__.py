@@ -1,2 +1,4 @@
 import fits
-import dat
\ No newline at end of file
+import dat
+import store
+import files
\ No newline at end of file
@@ -0,0 +1,114 @@
+"""Writing files so that readers never see part of one.
+
+A file is written under temporary_filename(filename), which no reader
+looks for, and then renamed over filename with replace once complete.
+write_npz and read_npz keep small caches, like the sidecar indices of
+data files, this way. A file updated in place instead is guarded by a
+FileLock, so that only one process at a time writes it."""
+
+import os
+import time
+import errno
+import numpy
+
+# A lock file older than this many seconds was left by a writer that
+#  died, and is broken (see FileLock).
+STALE_LOCK_SECONDS = 600
+# Seconds between attempts to take a lock held by someone else.
+LOCK_POLL_SECONDS = 0.1
+
+def temporary_filename( filename ):
+    """Returns the name to write filename under until it's complete."""
+    return '%s.%d.tmp' %(filename, os.getpid())
+
+def replace( tmp_filename, filename ):
+    """Renames tmp_filename to filename, replacing any file already there."""
+    if os.name == 'nt' and os.path.exists(filename):
+        # Windows won't rename onto an existing file.
+        os.remove(filename)
+    os.rename(tmp_filename, filename)
+
+class FileLock( object ):
+    """A lock on a file shared by every process, held by creating
+     <filename>.lock, which only one of them can do at a time.
+
+    Usage:
+        lock = FileLock(filename)
+        lock.acquire()
+        try:
+            ...write filename...
+        finally:
+            lock.release()
+
+    A lock file last touched more than STALE_LOCK_SECONDS ago is taken
+     to be left by a writer that died, and removed.
+    
+    """
+    def __init__( self, filename ):
+        self.lock_filename = filename + '.lock'
+
+    def acquire( self ):
+        while True:
+            try:
+                fd = os.open(self.lock_filename,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                os.write(fd, '%d\n' %os.getpid())
+                os.close(fd)
+                return
+            try:
+                if time.time() - os.path.getmtime(self.lock_filename) >\
+                   STALE_LOCK_SECONDS:
+                    print "Warning: breaking stale lock %s" %self.lock_filename
+                    os.remove(self.lock_filename)
+                    continue
+            except OSError:
+                # Released while we looked at it; try again.
+                continue
+            time.sleep(LOCK_POLL_SECONDS)
+
+    def release( self ):
+        os.remove(self.lock_filename)
+
+def write_npz( filename, **arrays ):
+    """numpy.savez(filename, **arrays), replacing filename only once the
+     new file is complete."""
+    tmp_filename = temporary_filename(filename)
+    try:
+        f = open(tmp_filename, 'wb')
+        try:
+            numpy.savez(f, **arrays)
+        finally:
+            f.close()
+        replace(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+def read_npz( filename, **key ):
+    """Returns the arrays of an .npz file as a dict, if it holds every
+     array of key with the value given there.
+
+    Returns None if it doesn't, or if the file is missing or can't be
+     read, which means whatever it caches should be worked out again."""
+    if not os.path.exists(filename):
+        return None
+    try:
+        saved = numpy.load(filename)
+        try:
+            arrays = dict((name, saved[name]) for name in saved.files)
+        finally:
+            saved.close()
+    except Exception:
+        # A truncated or damaged file can fail in many ways (zipfile
+        #  raises its own BadZipfile); any of them means rebuild it.
+        print "Warning: ignoring unreadable %s" %filename
+        return None
+    for name, value in key.items():
+        if name not in arrays or not numpy.array_equal(arrays[name], value):
+            return None
+    return arrays
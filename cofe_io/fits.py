@@ -1,58 +1,528 @@
+import os
+import glob
 import pyfits
 import numpy
 
+from files import read_npz, write_npz
+
+# FITS files are written in blocks of this many bytes.
+BLOCK = 2880
+# Table data is copied between files in chunks of this many bytes.
+COPY_CHUNK = 2**24
+# The column every servo device table is timestamped with, and the number
+#  of rows per block of the clock index of a file (see read_clock_index).
+CLOCK_COLUMN = 'computerClock'
+CLOCK_INDEX_ROWS = 1024
+# Tables read_clock_range reads whole even though they have a clock: the
+#  clock sync is needed from end to end to convert clocks to times.
+WHOLE_TABLES = ('CLOCKSYNC',)
+
+# The FITS binary table format codes of numpy scalar types, by kind and
+#  size. FITS has no unsigned integers wider than a byte, nor signed
+#  bytes, so those are stored offset by TZERO (see zeros).
+formats = {
+    ('b', 1) : 'L',
+    ('u', 1) : 'B',
+    ('i', 1) : 'B',
+    ('i', 2) : 'I',
+    ('u', 2) : 'I',
+    ('i', 4) : 'J',
+    ('u', 4) : 'J',
+    ('i', 8) : 'K',
+    ('u', 8) : 'K',
+    ('f', 4) : 'E',
+    ('f', 8) : 'D',
+    ('c', 8) : 'C',
+    ('c', 16) : 'M'
+    }
+zeros = {
+    ('i', 1) : -2**7,
+    ('u', 2) : 2**15,
+    ('u', 4) : 2**31,
+    ('u', 8) : 2**63
+    }
+
+class TableLayout( object ):
+    """How records of a numpy dtype are stored in a FITS binary table.
+
+    Every field becomes a column of the matching type (see formats), so
+     nothing is lost on the way; subarray fields become vector columns.
+     Raises ValueError for fields FITS can't hold, like unicode strings.
+    
+    """
+    def __init__( self, dtype ):
+        self.dtype = dtype
+        self.columns = []
+        self.offset_fields = []
+        self.logical_fields = []
+        storage = []
+        for name in dtype.names:
+            field = dtype.fields[name][0]
+            base, shape = field.base, field.shape
+            repeat = int(numpy.prod(shape))
+            key = (base.kind, base.itemsize)
+            tzero = None
+            if base.kind == 'S':
+                tform = '%dA' %(repeat * base.itemsize)
+                store = base
+            elif key in formats:
+                tform = '%d%s' %(repeat, formats[key])
+                store = base.newbyteorder('>')
+                if base.kind == 'b':
+                    store = numpy.dtype('u1')
+                    self.logical_fields.append(name)
+                elif key in zeros:
+                    # Flipping the top bit of an unsigned copy takes
+                    #  off (or adds) the offset.
+                    tzero = zeros[key]
+                    store = numpy.dtype('>u%d' %base.itemsize)
+                    top_bit = numpy.array(1 << (8*base.itemsize - 1), dtype=store)
+                    self.offset_fields.append((name, top_bit))
+            else:
+                raise ValueError("Can't write field %s of type %s to FITS"
+                                 %(name, base))
+            if len(shape) > 1:
+                tdim = '(%s)' %','.join(str(n) for n in reversed(shape))
+            else:
+                tdim = None
+            self.columns.append((name, tform, tzero, tdim))
+            storage.append((name, store, shape))
+        self.storage_dtype = numpy.dtype(storage)
+        # Records whose fields are all one plain type, like demodulated
+        #  data, convert fastest as a flat array of that type.
+        bases = set(dtype.fields[name][0].base for name in dtype.names)
+        self.scalar = None
+        if len(bases) == 1 and not self.logical_fields and not self.offset_fields\
+           and dtype.itemsize == self.storage_dtype.itemsize:
+            self.scalar = bases.pop()
+
+    def header( self, nrows, name=None, pcount=0 ):
+        """Returns the header of a table of nrows rows, as a string.
+
+        pcount is the size of the table's heap, the bytes after its rows."""
+        cards = [('XTENSION', 'BINTABLE'),
+                 ('BITPIX', 8),
+                 ('NAXIS', 2),
+                 ('NAXIS1', self.storage_dtype.itemsize),
+                 ('NAXIS2', nrows),
+                 ('PCOUNT', pcount),
+                 ('GCOUNT', 1),
+                 ('TFIELDS', len(self.columns))]
+        for i, (colname, tform, tzero, tdim) in enumerate(self.columns):
+            cards.append(('TTYPE%d' %(i+1), colname))
+            cards.append(('TFORM%d' %(i+1), tform))
+            if tzero is not None:
+                cards.append(('TZERO%d' %(i+1), tzero))
+            if tdim is not None:
+                cards.append(('TDIM%d' %(i+1), tdim))
+        if name is not None:
+            cards.append(('EXTNAME', name))
+        return pyfits.Header(cards).tostring()
+
+    def records( self, data ):
+        """Returns data as the table stores it: packed big-endian records.
+
+        That is data itself if it's stored that way already, and
+         otherwise a single converted copy."""
+        if data.dtype == self.storage_dtype and not self.logical_fields\
+           and not self.offset_fields and data.flags.c_contiguous:
+            return data
+        if self.scalar is not None and data.dtype == self.dtype\
+           and data.flags.c_contiguous:
+            flat = data.view(self.scalar).astype(self.scalar.newbyteorder('>'))
+            return flat.view(self.storage_dtype)
+        rows = data.astype(self.storage_dtype)
+        for name, top_bit in self.offset_fields:
+            field = rows[name]
+            field ^= top_bit
+        for name in self.logical_fields:
+            rows[name] = numpy.where(rows[name], ord('T'), ord('F'))
+        return rows
+
+class FitsWriter( object ):
+    """Writes a FITS file a binary table at a time, and a table a block
+     of rows at a time, without holding more than a block in memory.
+
+    Usage:
+        writer = FitsWriter(filename)
+        writer.start_table('DATA', dtype)
+        for block in blocks:
+            writer.append(block)
+        writer.close()
+
+    A table's row count is only known once it's done, so its header goes
+     out with NAXIS2 = 0 and is rewritten when the next table is started
+     or the file is closed.
+    primary is the pyfits header of the primary HDU, an empty one by
+     default. A table started with spare_bytes is followed by that many
+     zero bytes, counted as its heap, which rows can be appended into
+     later without moving the tables after it.
+    
+    """
+    def __init__( self, filename, primary=None ):
+        if primary is None:
+            primary = pyfits.PrimaryHDU().header
+        self.file = open(filename, 'wb')
+        self.file.write(primary.tostring())
+        self.layout = None
+
+    def start_table( self, name, dtype, spare_bytes=0 ):
+        """Finishes the current table and starts one with columns like dtype."""
+        self.finish_table()
+        self.layout = TableLayout(dtype)
+        self.name = name
+        self.nrows = 0
+        self.spare_bytes = spare_bytes
+        self.header_offset = self.file.tell()
+        self.file.write(self.layout.header(0, name, spare_bytes))
+
+    def append( self, rows ):
+        """Appends a block of rows with the table's dtype to the table."""
+        records = self.layout.records(rows)
+        records.tofile(self.file)
+        self.nrows += len(records)
+
+    def finish_table( self ):
+        if self.layout is None:
+            return
+        nbytes = self.nrows * self.layout.storage_dtype.itemsize + self.spare_bytes
+        self.file.write('\0' * self.spare_bytes)
+        self.file.write('\0' * (-nbytes % BLOCK))
+        end = self.file.tell()
+        self.file.seek(self.header_offset)
+        self.file.write(self.layout.header(self.nrows, self.name,
+                                           self.spare_bytes))
+        self.file.seek(end)
+        self.layout = None
+
+    def close( self ):
+        self.finish_table()
+        self.file.close()
+
 def write_fits( filename, data ):
     """Writes the contents of a dict to a .fits file.
     
-    The dict maps fits extension names onto one-dimensional arrays
-    of floats.
+    The dict maps fits extension names onto one-dimensional record
+    arrays. Each becomes a binary table whose columns have the types
+    of the array's fields (see TableLayout).
     
-    If rename_columns is given, it is used to map the dtype.names
-    of the given arrays onto the column names used in each extension.
+    """
+    writer = FitsWriter(filename)
+    try:
+        for ext_name, ext_array in data.items():
+            writer.start_table(ext_name, ext_array.dtype)
+            writer.append(ext_array)
+    finally:
+        writer.close()
+
+def select_data( hdu, columns=None, rows=None ):
+    """Returns a copy of the given columns and rows of an HDU's data.
+
+    columns is a sequence of column names, matched ignoring case as FITS
+    does; the ones a table doesn't have are left out. rows is a slice.
+    With the file opened with memmap=True, only the data asked for is
+    read. Returns None if there is no data or no columns are selected.
+    Signed byte columns (B with TZERO = -128, as TableLayout writes int8)
+    come back as int8, where pyfits would make them float64.
     
     """
-    hdul = pyfits.HDUList()
-    for ext_name, ext_array in data.items():
-        columns = []
-        for name in ext_array.dtype.names:
-            column = pyfits.Column( name=name,
-                                    format='E',
-                                    array=ext_array[name] )
-            columns.append(column)
-        ext = pyfits.new_table(columns)
-        ext.name = ext_name
-        hdul.append(ext)
-    hdul.writeto( filename, clobber=True )
+    data = hdu.data
+    if rows is None:
+        rows = slice(None)
+    if data is None:
+        return None
+    if not isinstance(hdu, (pyfits.BinTableHDU, pyfits.TableHDU)):
+        return numpy.array(data[rows])
+    if columns is None:
+        names = data.names
+    else:
+        wanted = set(name.lower() for name in columns)
+        names = [name for name in data.names if name.lower() in wanted]
+    if len(names) == 0:
+        return None
+    # The rows are taken from each field rather than from the table, since
+    #  pyfits forgets that unsigned columns are unsigned in a table slice.
+    #  Plain fields are views of the file, so this reads no more.
+    signed_bytes = set(col.name for col in hdu.columns
+                       if col.format.endswith('B') and col.bzero == -128
+                       and col.bscale in (None, 1))
+    raw = numpy.ndarray.view(data, numpy.ndarray)
+    fields = []
+    for name in names:
+        if name in signed_bytes:
+            # Flipping the top bit of the stored byte takes off the offset.
+            fields.append(raw[name][rows].view(numpy.int8) ^ numpy.int8(-2**7))
+        else:
+            fields.append(data.field(name)[rows])
+    result = numpy.empty(len(fields[0]), dtype=[(name, field.dtype, field.shape[1:])
+                                                for name, field in zip(names, fields)])
+    for name, field in zip(names, fields):
+        result[name] = field
+    return result
+
+def read_table( filename, extension=1, columns=None, rows=None ):
+    """Reads some columns and rows of one extension of a .fits file.
 
-def read_fits( filename, primary=True ):
-    """Reads a .fits file into a dict: {ext_name : ext_data}"""
+    extension is the extension's name or index. See select_data for
+    columns and rows.
+    
+    """
+    pf = pyfits.open(filename, memmap=True, uint=True)
+    try:
+        return select_data(pf[extension], columns, rows)
+    finally:
+        pf.close()
+
+def read_fits( filename, primary=True, extensions=None, columns=None, rows=None ):
+    """Reads a .fits file into a dict: {ext_name : ext_data}
+    
+    The file is memory-mapped and only what is asked for is copied:
+     extensions: the names or indices of the extensions to read; those
+      the file doesn't have are skipped.
+     columns: the column names to read from every table, or a dict
+      giving them by extension name.
+     rows: a slice of the rows to read from each table.
+    Each defaults to everything. Extensions without data, or without
+    any of the columns, are left out.
+    
+    """
+    result = {}
+    pf = pyfits.open(filename, memmap=True, uint=True)
+    try:
+        if extensions is None:
+            hdus = pf[:] if primary else pf[1:]
+        else:
+            hdus = []
+            for ext in extensions:
+                try:
+                    hdus.append(pf[ext])
+                except (KeyError, IndexError):
+                    pass
+        for ext in hdus:
+            if isinstance(columns, dict):
+                if ext.name not in columns:
+                    continue
+                ext_columns = columns[ext.name]
+            else:
+                ext_columns = columns
+            data = select_data(ext, ext_columns, rows)
+            if data is not None:
+                result[ext.name] = data
+    finally:
+        pf.close()
+    return result
+
+
+def clock_index_filename( filename ):
+    return os.path.splitext(filename)[0] + '.clkidx'
+
+def build_clock_index( filename, block_rows=CLOCK_INDEX_ROWS ):
+    """Returns {ext_name : (mins, maxs)}, the range of computerClock in
+     each block of block_rows rows of each table with that column."""
+    index = {}
+    pf = pyfits.open(filename, memmap=True, uint=True)
+    try:
+        for hdu in pf[1:]:
+            if hdu.data is None or CLOCK_COLUMN.lower() not in\
+               [name.lower() for name in hdu.data.names]:
+                continue
+            clock = hdu.data.field(CLOCK_COLUMN)
+            blocks = numpy.arange(0, len(clock), block_rows)
+            if len(blocks) == 0:
+                index[hdu.name] = (numpy.zeros(0), numpy.zeros(0))
+            else:
+                index[hdu.name] = (numpy.minimum.reduceat(clock, blocks),
+                                   numpy.maximum.reduceat(clock, blocks))
+    finally:
+        pf.close()
+    return index
+
+def table_rows( filename ):
+    """Returns the number of rows (NAXIS2) of each extension of a .fits
+     file, read from the headers alone."""
+    pf = pyfits.open(filename, memmap=True)
+    try:
+        return numpy.array([hdu.header.get('NAXIS2', 0) for hdu in pf[1:]],
+                           dtype=numpy.int64)
+    finally:
+        pf.close()
+
+def read_clock_index( filename, update=True ):
+    """Returns (block_rows, {ext_name : (mins, maxs)}) for a .fits file,
+     using its sidecar index.
+
+    The index is trusted only if it was built from a file of the same
+    size, modification time and number of rows in each table, since rows
+    appended in place into spare heap space leave the size unchanged.
+    Otherwise the clock columns are read again and, if update is True,
+    the sidecar is rewritten.
+    
+    """
+    stat = os.stat(filename)
+    rows = table_rows(filename)
+    index_filename = clock_index_filename(filename)
+    saved = read_npz(index_filename, size=stat.st_size, mtime=stat.st_mtime,
+                     rows=rows)
+    if saved is not None:
+        index = {}
+        for key in saved:
+            if key.startswith('min_'):
+                name = key[len('min_'):]
+                index[name] = (saved[key], saved['max_'+name])
+        return int(saved['block_rows']), index
+    index = build_clock_index(filename)
+    if update:
+        try:
+            write_clock_index(filename, index, stat, rows)
+        except (IOError, OSError):
+            print "Warning: could not write index %s" %index_filename
+    return CLOCK_INDEX_ROWS, index
+
+def write_clock_index( filename, index, stat, rows,
+                       block_rows=CLOCK_INDEX_ROWS ):
+    """Writes the sidecar index, under a temporary name until it's complete."""
+    arrays = {'size' : numpy.int64(stat.st_size),
+              'mtime' : numpy.float64(stat.st_mtime),
+              'rows' : rows,
+              'block_rows' : numpy.int64(block_rows)}
+    for name, (mins, maxs) in index.items():
+        arrays['min_'+name] = mins
+        arrays['max_'+name] = maxs
+    write_npz(clock_index_filename(filename), **arrays)
+
+def read_clock_range( filename, start, stop, extensions=None, columns=None,
+                      whole=WHOLE_TABLES ):
+    """Reads the rows with computerClock in [start, stop) of a .fits file.
+
+    Like read_fits(filename, primary=False, ...), but only the blocks of
+    rows whose clock range overlaps [start, stop) are read, found with
+    the file's clock index. Tables without a clock, or named in whole,
+    are read whole. The clock column is always included.
+    
+    """
+    block_rows, index = read_clock_index(filename)
+    if isinstance(columns, dict):
+        columns = dict((name, list(ext_columns) + [CLOCK_COLUMN])
+                       for name, ext_columns in columns.items())
+    elif columns is not None:
+        columns = list(columns) + [CLOCK_COLUMN]
+    if extensions is not None:
+        # Extension names match whatever their case, as in read_fits.
+        extensions = [ext.upper() if isinstance(ext, basestring) else ext
+                      for ext in extensions]
     result = {}
-    pf = pyfits.open(filename)
-    if not primary:
-        pf = pf[1:]
-    for ext in pf:
-        result[ext.name] = numpy.array(ext.data)
-        #print "%s dtype:"%filename, result[ext.name].dtype
-    pf.close()
+    pf = pyfits.open(filename, memmap=True, uint=True)
+    try:
+        for i, hdu in enumerate(pf):
+            if i == 0:
+                continue
+            if extensions is not None and hdu.name.upper() not in extensions\
+               and i not in extensions:
+                continue
+            if isinstance(columns, dict):
+                if hdu.name not in columns:
+                    continue
+                ext_columns = columns[hdu.name]
+            else:
+                ext_columns = columns
+            if hdu.name not in index or hdu.name.upper() in whole:
+                data = select_data(hdu, ext_columns)
+            else:
+                mins, maxs = index[hdu.name]
+                blocks = numpy.flatnonzero((maxs >= start) & (mins < stop))
+                if len(blocks) == 0:
+                    continue
+                rows = slice(blocks[0] * block_rows, (blocks[-1] + 1) * block_rows)
+                data = select_data(hdu, ext_columns, rows)
+                if data is not None:
+                    clock = data[CLOCK_COLUMN]
+                    data = data[(clock >= start) & (clock < stop)]
+            if data is not None:
+                result[hdu.name] = data
+    finally:
+        pf.close()
     return result
 
+def copy_bytes( source, destination, nbytes, chunk=COPY_CHUNK ):
+    """Copies nbytes from the source file to the destination file."""
+    while nbytes > 0:
+        data = source.read(min(chunk, nbytes))
+        if len(data) == 0:
+            raise IOError("%s ended early" %source.name)
+        destination.write(data)
+        nbytes -= len(data)
+
+def table_columns( header ):
+    """Returns the column definitions in a binary table header, which
+     tables must share to be concatenated."""
+    keys = ['NAXIS1', 'TFIELDS']
+    for i in range(1, header['TFIELDS']+1):
+        keys.extend(key %i for key in ('TTYPE%d', 'TFORM%d', 'TZERO%d',
+                                       'TSCAL%d', 'TDIM%d', 'TNULL%d'))
+    return [header.get(key) for key in keys]
 
 def concatenate_fits(folder):
     """Concatenates the data for every fits file in a given folder.
     
-    Output file is <folder name>.fits.
+    Output file is <folder name>.fits. It has a table for each extension
+    name found in the files, holding the rows of that extension from
+    every file that has it, in filename order.
+    
+    The headers are all read first, so each table is written once at
+    its final size, and then each file's rows are copied over as they
+    are stored, a chunk at a time. Raises ValueError if the columns of
+    an extension differ between files.
     
     """
     outfilename = "%s.fits" % folder
-    filenames = glob.glob(os.path.join(folder, '*.fits'))
-    hdulist = pyfits.open(filenames[0])
-    for f in filenames[1:]:
-        ff = pyfits.open(f)
-        for i in range(1, len(hdulist)):
-            prevlength = len(hdulist[i].data)
-            hdulist[i] = pyfits.new_table(hdulist[i].columns, nrows=prevlength + len(ff[i].data))
-            hdulist[i].name = ff[i].name
-            for name in hdulist[i].columns.names:
-                hdulist[i].data.field(name)[prevlength:] = ff[i].data.field(name)
-        ff.close()
-    hdulist.writeto(outfilename, clobber=True)
+    filenames = sorted(glob.glob(os.path.join(folder, '*.fits')))
+    if len(filenames) == 0:
+        print("No .fits files in %s" % folder)
+        return
+    ext_names = []
+    # ext name : [header, columns, [(filename, data offset, rows)]]
+    tables = {}
+    for filename in filenames:
+        pf = pyfits.open(filename)
+        try:
+            for i in range(1, len(pf)):
+                header = pf[i].header
+                if header['XTENSION'] != 'BINTABLE':
+                    raise ValueError("%s[%d] isn't a binary table" %(filename, i))
+                columns = table_columns(header)
+                formats = [header['TFORM%d' %j] for j in range(1, header['TFIELDS']+1)]
+                if any('P' in f or 'Q' in f for f in formats):
+                    raise ValueError("%s[%d] has variable-length columns"
+                                     %(filename, i))
+                name = pf[i].name
+                if name not in tables:
+                    ext_names.append(name)
+                    tables[name] = [header.copy(), columns, []]
+                elif columns != tables[name][1]:
+                    raise ValueError("The columns of %s in %s differ from those"
+                                     " in earlier files" %(name, filename))
+                tables[name][2].append((filename, pf.fileinfo(i)['datLoc'],
+                                        header['NAXIS2']))
+        finally:
+            pf.close()
+
+    out = open(outfilename, 'wb')
+    try:
+        out.write(pyfits.PrimaryHDU().header.tostring())
+        for name in ext_names:
+            header, columns, pieces = tables[name]
+            header['NAXIS2'] = sum(nrows for f, offset, nrows in pieces)
+            header['PCOUNT'] = 0
+            if 'THEAP' in header:
+                del header['THEAP']
+            out.write(header.tostring())
+            for filename, offset, nrows in pieces:
+                f = open(filename, 'rb')
+                try:
+                    f.seek(offset)
+                    copy_bytes(f, out, nrows * header['NAXIS1'])
+                finally:
+                    f.close()
+            out.write('\0' * (-header['NAXIS1'] * header['NAXIS2'] % BLOCK))
+    finally:
+        out.close()
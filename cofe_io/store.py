@@ -0,0 +1,180 @@
+"""A columnar format for record arrays: a directory per dataset holding
+
+  <column name>.col   the column's values, one after another
+  index.npz           the dtype, the chunk size and the chunk index
+
+Rows are grouped into chunks of chunk_rows rows (the last one may be
+shorter), and the index gives the smallest and largest value of each of
+the INDEX_COLUMNS the dataset has in every chunk. Reading one column
+over a range of computerClock or rev then only touches the chunks that
+can hold the range, and only that column's file.
+
+Appending writes the new rows to the end of each column file and then
+replaces the index, so readers never see rows that aren't all there."""
+
+import os
+import ast
+import numpy
+
+from files import write_npz
+
+# Columns whose range in each chunk is recorded.
+INDEX_COLUMNS = ('computerClock', 'rev')
+# Rows per chunk of new datasets.
+CHUNK_ROWS = 2**16
+INDEX_FILENAME = 'index.npz'
+
+def column_filename( path, name ):
+    return os.path.join(path, name + '.col')
+
+class Store( object ):
+    """A dataset in the columnar format, opened for reading and appending."""
+    def __init__( self, path ):
+        self.path = path
+        index = numpy.load(os.path.join(path, INDEX_FILENAME))
+        self.dtype = numpy.dtype(ast.literal_eval(str(index['descr'])))
+        self.chunk_rows = int(index['chunk_rows'])
+        self.chunk_sizes = index['chunk_sizes']
+        self.index_columns = [name for name in INDEX_COLUMNS
+                              if name in self.dtype.names]
+        self.mins = dict((name, index['min_'+name]) for name in self.index_columns)
+        self.maxs = dict((name, index['max_'+name]) for name in self.index_columns)
+        index.close()
+
+    def __len__( self ):
+        return int(self.chunk_sizes.sum())
+
+    def column_filename( self, name ):
+        return column_filename(self.path, name)
+
+    def column( self, name ):
+        """Returns a read-only memmap of a column."""
+        field = self.dtype.fields[name][0]
+        shape = (len(self),) + field.shape
+        if len(self) == 0:
+            return numpy.zeros(shape, dtype=field.base)
+        return numpy.memmap(self.column_filename(name), dtype=field.base,
+                            mode='r', shape=shape)
+
+    def read( self, columns=None, rows=None ):
+        """Returns a copy of some columns and rows as a record array.
+
+        columns defaults to all of them, and rows, a slice or an array
+         of row numbers, to all of them."""
+        if columns is None:
+            columns = self.dtype.names
+        if rows is None:
+            rows = slice(None)
+        fields = [self.column(name)[rows] for name in columns]
+        result = numpy.empty(len(fields[0]) if fields else 0,
+                             dtype=[(name, self.dtype.fields[name][0])
+                                    for name in columns])
+        for name, field in zip(columns, fields):
+            result[name] = field
+        return result
+
+    def chunks_in_range( self, key, start, stop ):
+        """Returns the chunks whose key values may fall in [start, stop)."""
+        return numpy.flatnonzero((self.maxs[key] >= start) &
+                                 (self.mins[key] < stop))
+
+    def rows_in_range( self, key, start, stop ):
+        """Returns the row numbers whose key value is in [start, stop).
+
+        key is one of the index columns. Only the chunks that can hold
+         such values are read."""
+        chunks = self.chunks_in_range(key, start, stop)
+        if len(chunks) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        first = chunks[0] * self.chunk_rows
+        last = min((chunks[-1] + 1) * self.chunk_rows, len(self))
+        values = self.column(key)[first:last]
+        return first + numpy.flatnonzero((values >= start) & (values < stop))
+
+    def read_range( self, key, start, stop, columns=None ):
+        """Returns the rows whose key value is in [start, stop), as read()."""
+        rows = self.rows_in_range(key, start, stop)
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            rows = slice(rows[0], rows[-1] + 1)
+        return self.read(columns, rows)
+
+    def append( self, data ):
+        """Appends a record array with the dataset's fields to it."""
+        nrows = len(self)
+        for name in self.dtype.names:
+            f = open(self.column_filename(name), 'ab')
+            try:
+                # Drop anything left by an append that didn't finish.
+                f.truncate(nrows * self.dtype.fields[name][0].itemsize)
+                f.seek(0, os.SEEK_END)
+                numpy.ascontiguousarray(data[name],
+                                        dtype=self.dtype.fields[name][0].base)\
+                    .tofile(f)
+            finally:
+                f.close()
+
+        # Update the index of the last chunk and add those of new ones.
+        sizes = list(self.chunk_sizes)
+        mins = dict((name, list(self.mins[name])) for name in self.index_columns)
+        maxs = dict((name, list(self.maxs[name])) for name in self.index_columns)
+        done = 0
+        while done < len(data):
+            if sizes and sizes[-1] < self.chunk_rows:
+                chunk = len(sizes) - 1
+            else:
+                chunk = len(sizes)
+                sizes.append(0)
+            n = min(self.chunk_rows - sizes[chunk], len(data) - done)
+            for name in self.index_columns:
+                values = data[name][done:done+n]
+                if chunk < len(mins[name]):
+                    mins[name][chunk] = min(mins[name][chunk], values.min())
+                    maxs[name][chunk] = max(maxs[name][chunk], values.max())
+                else:
+                    mins[name].append(values.min())
+                    maxs[name].append(values.max())
+            sizes[chunk] += n
+            done += n
+        self.chunk_sizes = numpy.array(sizes, dtype=numpy.int64)
+        for name in self.index_columns:
+            field = self.dtype.fields[name][0]
+            self.mins[name] = numpy.array(mins[name], dtype=field)
+            self.maxs[name] = numpy.array(maxs[name], dtype=field)
+        write_index(self.path, self.dtype, self.chunk_rows, self.chunk_sizes,
+                    self.mins, self.maxs)
+
+def write_index( path, dtype, chunk_rows, chunk_sizes, mins, maxs ):
+    """Replaces the index file of the dataset at path.
+
+    mins and maxs map each index column to its per-chunk extremes."""
+    arrays = {'descr' : numpy.array(repr(dtype.descr)),
+              'chunk_rows' : numpy.array(chunk_rows),
+              'chunk_sizes' : chunk_sizes}
+    for name in mins:
+        arrays['min_'+name] = mins[name]
+        arrays['max_'+name] = maxs[name]
+    write_npz(os.path.join(path, INDEX_FILENAME), **arrays)
+
+def create_store( path, dtype, chunk_rows=CHUNK_ROWS ):
+    """Makes an empty dataset with the given dtype in a new directory."""
+    dtype = numpy.dtype(dtype)
+    if any(os.sep in name for name in dtype.names):
+        raise ValueError("Column names can't contain %r" %os.sep)
+    os.makedirs(path)
+    for name in dtype.names:
+        open(column_filename(path, name), 'wb').close()
+    empty = dict((name, numpy.zeros(0, dtype=dtype.fields[name][0]))
+                 for name in INDEX_COLUMNS if name in dtype.names)
+    write_index(path, dtype, chunk_rows, numpy.zeros(0, dtype=numpy.int64),
+                empty, empty)
+    return Store(path)
+
+def write_store( path, data, chunk_rows=CHUNK_ROWS ):
+    """Writes a record array to disk as a new dataset."""
+    store = create_store(path, data.dtype, chunk_rows)
+    store.append(data)
+    return store
+
+def read_store( path, columns=None ):
+    """Reads some columns of a dataset (all by default) into a record array."""
+    return Store(path).read(columns)
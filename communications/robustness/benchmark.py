@@ -0,0 +1,127 @@
+"""Usage:
+  benchmark.py [MAX_SIZE]
+Times how long HeaderedStream takes to read a stream of packets, for
+packets of 64 bytes up to MAX_SIZE bytes (4MB by default), against the
+old implementation that kept its buffer in a string. The stream is
+handed over at most RECV_SIZE bytes at a time, like a socket would, and
+there's a little garbage between packets so headers have to be hunted for."""
+
+import sys
+import time
+
+from headers import HeaderedStream, header, parse_header,\
+                    generate_message_checksum, HEADER_SIZE, IDENTIFYING_STRING,\
+                    is_valid_header
+
+# Most bytes a read from the stream returns: the TCP payload of one
+#  Ethernet frame.
+RECV_SIZE = 1460
+# Bytes of packets read for each size.
+STREAM_SIZE = 2**23
+GARBAGE = 'GARBAGE!'
+
+class StringHeaderedStream( HeaderedStream ):
+    """The old HeaderedStream, which kept recv_buffer as a string."""
+    def __init__( self, read_function, write_function ):
+        self.read_function = read_function
+        self.write_function = write_function
+        self.recv_buffer = ''
+
+    def read( self ):
+        while True:
+            self.read_until_header()
+            h = self.read_chars(HEADER_SIZE, exact=True)
+            try:
+                meta, size, hchecksum, mchecksum = parse_header(h)
+            except ValueError:
+                continue
+            result = self.read_chars(size, exact=True)
+            if generate_message_checksum( result ) == mchecksum:
+                print "Read %d chars." %len(result)
+                return result, meta
+
+    def read_until_header( self ):
+        i = self.find_header_in_buffer()
+        while i == -1:
+            self.recv_buffer = self.recv_buffer[-HEADER_SIZE:]
+            # The old code used read_chars here, which hands back what's
+            #  left in recv_buffer without reading, and so spun forever
+            #  on a header split between two reads.
+            self.recv_buffer += self.read_function(self.READ_SIZE)
+            i = self.find_header_in_buffer()
+        self.recv_buffer = self.recv_buffer[i:]
+
+    def find_header_in_buffer( self ):
+        i = self.recv_buffer.find(IDENTIFYING_STRING)
+        while i != -1:
+            if is_valid_header( self.recv_buffer[i:i+HEADER_SIZE] ):
+                return i
+            i = self.recv_buffer.find(IDENTIFYING_STRING,i+1)
+        return i
+
+    def read_chars( self, maxsize, exact=False ):
+        minsize = (maxsize if exact else 1)
+        result, self.recv_buffer = self.recv_buffer[:maxsize], self.recv_buffer[maxsize:]
+        while len(result) < minsize:
+            result += self.read_function(maxsize-len(result))
+        return result
+
+class Source( object ):
+    """Hands out a string RECV_SIZE bytes at a time, like a socket."""
+    def __init__( self, data ):
+        self.data = data
+        self.pos = 0
+    def read( self, maxsize ):
+        n = min(maxsize, RECV_SIZE, len(self.data) - self.pos)
+        result = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return result
+    def readinto( self, buf ):
+        n = min(len(buf), RECV_SIZE, len(self.data) - self.pos)
+        buf[:n] = buffer(self.data, self.pos, n)
+        self.pos += n
+        return n
+
+class Quiet( object ):
+    """Swallows HeaderedStream's printing while it's being timed."""
+    def write( self, s ):
+        pass
+
+def packets( size, count ):
+    message = ''.join(chr(i % 251) for i in range(size))
+    return (header(message) + message + GARBAGE) * count, message
+
+def time_reads( stream, count, message ):
+    stdout, sys.stdout = sys.stdout, Quiet()
+    try:
+        t = time.time()
+        for i in range(count):
+            data, meta = stream.read()
+        t = time.time() - t
+    finally:
+        sys.stdout = stdout
+    assert data == message
+    return t
+
+def benchmark( max_size=2**22 ):
+    print "%10s %8s %12s %12s %12s %8s" %("size", "packets", "string (s)",
+                                          "read (s)", "readinto (s)", "speedup")
+    size = 64
+    while size <= max_size:
+        count = max(STREAM_SIZE // (size + HEADER_SIZE + len(GARBAGE)), 1)
+        data, message = packets(size, count)
+        times = []
+        for make_stream in (lambda s: StringHeaderedStream(s.read, None),
+                            lambda s: HeaderedStream(s.read, None),
+                            lambda s: HeaderedStream(None, None, s.readinto)):
+            times.append(time_reads(make_stream(Source(data)), count, message))
+        print "%10d %8d %12.3f %12.3f %12.3f %8.1f" %((size, count) +
+                                                       tuple(times) +
+                                                       (times[0]/times[2],))
+        size *= 4
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        benchmark(int(sys.argv[1]))
+    else:
+        benchmark()
@@ -38,6 +38,8 @@
 #  Assume you have a function read_stream which takes an integer N and returns
 #   a string no more than N bytes long, and a function write_stream which takes
 #   a string.
+#  (If the input stream can read into a buffer like socket.recv_into, pass
+#   that as a third argument too, and received data won't be copied around.)
 #  HeaderedStream( read_stream, write_stream ) returns an object
 #  with two important methods:
 #   hs.write(s) calculates the header for the given string, and passes
@@ -130,9 +132,10 @@ def generate_header_checksum( meta, size ):
     result = meta*9733 + size*8111
     result %= 10**NUM_HCHECKSUM_CHARS
     return result
+MESSAGE_CHECKSUM_PRIMES = [8599,8933,5839,6359,7207,11027,823,1283,2713,2909]
 def generate_message_checksum( s ):
     """Returns a hash dependent on the first and last several characters of a string."""
-    primes = [8599,8933,5839,6359,7207,11027,823,1283,2713,2909]
+    primes = MESSAGE_CHECKSUM_PRIMES
     result = 0
     for i in range(min(len(primes),len(s))):
         result += primes[i] * ord(s[i])
@@ -140,6 +143,15 @@ def generate_message_checksum( s ):
     result %= 10**NUM_MCHECKSUM_CHARS
     return result
 
+def buffer_checksum( buf, start, size ):
+    """generate_message_checksum of buf[start:start+size], for a bytearray buf."""
+    n = min(len(MESSAGE_CHECKSUM_PRIMES), size)
+    first = buf[start:start+n]
+    last = buf[start+size-n:start+size]
+    last.reverse()
+    result = sum(p*(a+b) for p,a,b in zip(MESSAGE_CHECKSUM_PRIMES, first, last))
+    return result % 10**NUM_MCHECKSUM_CHARS
+
 def is_valid_header( h ):
     """Returns whether a header's shape and checksum is valid."""
     if len(h) != HEADER_SIZE:
@@ -166,70 +178,155 @@ def parse_header( h ):
     mchecksum = int(h)
     return meta, size, hchecksum, mchecksum
 
+_META_START = len(IDENTIFYING_STRING)
+_SIZE_START = _META_START + NUM_META_CHARS
+_HCHECKSUM_START = _SIZE_START + NUM_SIZE_CHARS
+_MCHECKSUM_START = _HCHECKSUM_START + NUM_HCHECKSUM_CHARS
+def unpack_header( h ):
+    """Returns parse_header(h), or None if h isn't a valid header.
+
+    Looks at h only once, for reading headers out of a stream fast."""
+    if len(h) != HEADER_SIZE or not h.startswith(IDENTIFYING_STRING):
+        return None
+    try:
+        meta = int(h[_META_START:_SIZE_START])
+        size = int(h[_SIZE_START:_HCHECKSUM_START])
+        hchecksum = int(h[_HCHECKSUM_START:_MCHECKSUM_START])
+        mchecksum = int(h[_MCHECKSUM_START:])
+    except ValueError:
+        return None
+    if generate_header_checksum(meta,size) != hchecksum:
+        return None
+    return meta, size, hchecksum, mchecksum
+
 
 class HeaderedStream( object ):
     READ_SIZE = 4096
-    def __init__( self, read_function, write_function ):
+    def __init__( self, read_function, write_function, readinto_function=None ):
         self.read_function = read_function
             # Takes an integer argument, returns a string of up to that length.
             # The input stream.
         self.write_function = write_function
             # Takes a string. The output stream.
+        self.readinto_function = readinto_function
+            # Optional. Takes a writable buffer, fills some of it from the
+            #  input stream like socket.recv_into, and returns the number of
+            #  bytes read. Used instead of read_function if given, which
+            #  saves copying everything received.
+
+        self.recv_buffer = bytearray(2*self.READ_SIZE)
+        self.start = self.end = 0
+            # recv_buffer[start:end] is the data that we've read from the
+            #  input stream but not processed yet. Generated by fill and
+            #  consumed by read_view. The space around it is reused, so
+            #  reading costs time in proportion to the bytes received, not
+            #  to the square of the message size.
+        self.header = None
+            # The fields of the header at recv_buffer[start], as parse_header
+            #  gives them, once find_header_in_buffer has found it.
 
-        self.recv_buffer = ''
-            # The buffer for data that we've read from read_function
-            #  but not processed yet. Generated by read_until_header
-            #  and consumed by read_chars.
-        
     def read( self ):
         """Returns next valid data packet in queue, or next received."""
+        view, meta = self.read_view()
+        return view.tobytes(), meta
+
+    def read_view( self ):
+        """Like read, but returns the packet as a memoryview into recv_buffer.
+
+        This saves copying the packet, but the view is only good until the
+         next read."""
         while True:
             self.read_until_header()
-            h = self.read_chars(HEADER_SIZE, exact=True)
-            try:
-                meta, size, hchecksum, mchecksum = parse_header(h)
-            except ValueError:
-                # For robustness for COFE, I'll catch this error.
-                # In any other application, I'd take out this try/except.
-                continue
-            result = self.read_chars(size, exact=True)
-            if generate_message_checksum( result ) == mchecksum:
-                #print "Read %s" %result
-                print "Read %d chars." %len(result)
-                return result, meta
-        
+            meta, size, hchecksum, mchecksum = self.header
+            self.start += HEADER_SIZE
+            self.require(size)
+            first, self.start = self.start, self.start + size
+            if buffer_checksum( self.recv_buffer, first, size ) == mchecksum:
+                print "Read %d chars." %size
+                return memoryview(self.recv_buffer)[first:first+size], meta
+
     def write( self, data, meta=0 ):
         """Writes the string data using the given function."""
         self.write_function( header(data,meta=meta) + data )
         #print "Wrote %s" %data
         print "Wrote %d chars." %len(data)
-    
+
     def read_until_header( self ):
-        """Reads from the given function until a header is reached, puts header and some following data in recv_buffer"""
-        i = self.find_header_in_buffer()
-        while i == -1:
-            self.recv_buffer = self.recv_buffer[-HEADER_SIZE:]
-            self.recv_buffer += self.read_chars(self.READ_SIZE)
-            i = self.find_header_in_buffer()
-        self.recv_buffer = self.recv_buffer[i:]
-        
+        """Reads from the input stream until a whole valid header is at recv_buffer[start].
+
+        Its fields are left in self.header."""
+        while self.find_header_in_buffer() == -1:
+            self.fill(self.READ_SIZE)
+
     def find_header_in_buffer( self ):
-        """Returns starting index of first valid header in recv_buffer, or -1 if none is found."""
-        i = self.recv_buffer.find(IDENTIFYING_STRING)
+        """Returns the index of the first valid header in recv_buffer, or -1 if none is found.
+
+        Drops the data before it (all but the end that could begin a header,
+         if there's no header) so nothing is searched twice."""
+        buf = self.recv_buffer
+        i = buf.find(IDENTIFYING_STRING, self.start, self.end)
         while i != -1:
-            if is_valid_header( self.recv_buffer[i:i+HEADER_SIZE] ):
+            if i + HEADER_SIZE > self.end:
+                # Could be a header we haven't finished reading.
+                self.start = i
+                return -1
+            self.header = unpack_header( str(buf[i:i+HEADER_SIZE]) )
+            if self.header is not None:
+                self.start = i
                 return i
-            i = self.recv_buffer.find(IDENTIFYING_STRING,i+1)
-        return i
-            
-    def read_chars( self, maxsize, exact=False ):
-        """Returns up to n bytes from the input stream (exactly n if exact is True)."""
-        minsize = (maxsize if exact else 1)
-        result, self.recv_buffer = self.recv_buffer[:maxsize], self.recv_buffer[maxsize:]
-        while len(result) < minsize:
-            result += self.read_function(maxsize-len(result))
-        assert minsize <= len(result) <= maxsize
-        return result
+            i = buf.find(IDENTIFYING_STRING, i+1, self.end)
+        self.start = max(self.start, self.end - len(IDENTIFYING_STRING) + 1)
+        return -1
+
+    def require( self, size ):
+        """Reads from the input stream until recv_buffer holds size unprocessed bytes."""
+        missing = size - (self.end - self.start)
+        if missing > 0:
+            self.fill(missing, exact=True)
+
+    def fill( self, size, exact=False ):
+        """Reads at least one byte into recv_buffer (exactly size if exact is True).
+
+        Makes room for size bytes first, and reads up to READ_SIZE more if
+         the input stream has them ready. Raises EOFError if a read from
+         the input stream returns nothing, which means it has ended."""
+        self.make_room(size)
+        view = memoryview(self.recv_buffer)
+        readinto, read = self.readinto_function, self.read_function
+        end = self.end
+        stop = end + (size if exact else 1)
+        limit = min(len(view), max(stop, end + self.READ_SIZE))
+        try:
+            while end < stop:
+                if readinto is not None:
+                    n = readinto(view[end:limit])
+                else:
+                    data = read(limit - end)
+                    n = len(data)
+                    view[end:end+n] = data
+                if n <= 0:
+                    raise EOFError( "the input stream returned no data" )
+                end += n
+        finally:
+            self.end = end
+
+    def make_room( self, size ):
+        """Makes sure there are size free bytes after recv_buffer[end]."""
+        if len(self.recv_buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if len(self.recv_buffer) >= pending + size:
+            # Move the unprocessed data back to the front. Only the end of a
+            #  header or message we're still reading is ever left over, so
+            #  this copies less than is about to be read.
+            self.recv_buffer[:pending] = self.recv_buffer[self.start:self.end]
+        else:
+            # A new buffer, since read_view's views may still be around and
+            #  a bytearray with views can't be resized.
+            buf = bytearray(pending + size + self.READ_SIZE)
+            buf[:pending] = memoryview(self.recv_buffer)[self.start:self.end]
+            self.recv_buffer = buf
+        self.start, self.end = 0, pending
 
 
 if __name__ == '__main__':
@@ -85,20 +85,26 @@ class RobustSocket( HeaderedStream ):
         self.connected = threading.Event()
         self.connected.clear()
         
-        HeaderedStream.__init__( self, self.read_from_socket, self.write_to_socket )
+        HeaderedStream.__init__( self, self.read_from_socket, self.write_to_socket,
+                                 self.read_into_from_socket )
     
     def read( self ):
         return HeaderedStream.read(self)[0]
     
     def read_from_socket( self, maxsize ):
+        buf = bytearray(maxsize)
+        n = self.read_into_from_socket(buf)
+        return str(buf[:n])
+    
+    def read_into_from_socket( self, buf ):
         while True:
             try:
                 self.connected.wait()
                 with self.state.contexts['connected']:
-                    result = self.conn.recv(maxsize)
-                if not result:
+                    n = self.conn.recv_into(buf)
+                if n == 0:
                     raise socket.error
-                return result
+                return n
             except socket.timeout:
                 print "Timed out while reading."
                 pass
@@ -28,6 +28,37 @@ def paths_in_time_range( paths, start, end ):
     """Returns the set of given paths between the start and end times."""
     return filter((lambda p: (start < path_to_datetime(p) < end)), paths)
 
+_FILETIME_ZERO = datetime.datetime(1601,1,1,0,0,0)
+def datetime_to_filetime( t ):
+    """Converts a datetime to a filetime (100-ns increments since Jan 1, 1601)."""
+    delta = t - _FILETIME_ZERO
+    return (delta.days*86400 + delta.seconds)*10**7 + delta.microseconds*10
+
+def clock_fit( path ):
+    """Returns (slope, offset) converting filetime to a file's computerClock.
+
+    Uses the file's ClockSync data, which matches computerClock to
+    filetime, fitting a line through it so that times outside it can
+    be converted too. Returns None if there isn't enough of it.
+    
+    """
+    sync = fitsio.read_fits(path, extensions=['CLOCKSYNC'],
+                            columns=['computerClock', 'filetime'])
+    sync = sync.get('CLOCKSYNC')
+    if sync is None or len(numpy.unique(sync['filetime'])) < 2:
+        return None
+    slope, offset = numpy.polyfit(sync['filetime'], sync['computerClock'], 1)
+    return slope, offset
+
+def clock_window( fit, start, end ):
+    """Returns the computerClock range between two datetimes, given a
+     clock_fit, or None if the fit is None."""
+    if fit is None:
+        return None
+    slope, offset = fit
+    return (slope*datetime_to_filetime(start) + offset,
+            slope*datetime_to_filetime(end) + offset)
+
 def mean( data ):
     """Returns the mean of a one-dimensional array.
     
@@ -51,7 +82,10 @@ class ConversionThread( threading.Thread ):
         self.conversion_lock = threading.Lock()
     
     def convert_files( self, files, clobber=False ):
-        """Converts a bunch of files into _ext.fits files."""
+        """Converts a bunch of files into _ext.fits files.
+
+        The spaceballs may still be being written, so each is converted
+         up to its last whole record (see reshaping.update_spaceball)."""
         self.conversion_lock.acquire()
         for f in files:
             # Since we have multiple threads going, the file may have
@@ -59,7 +93,7 @@ class ConversionThread( threading.Thread ):
             #  since our caller checked. Let's just print a warning
             #  if that's the case -- no need to end the program.
             if os.path.exists(f):
-                reshaping.convert_file(f, clobber=clobber)
+                reshaping.convert_file(f, clobber=clobber, growing=True)
             else:
                 print "WARNING: {0} does not exist".format(f)
             
@@ -113,6 +147,12 @@ class FitsManager( object ):
                          os.path.join(folder,'*','*_ext.fits')).start()
         
         self.data = {}
+        # The computerClock window loaded from each file in self.data,
+        #  or None if all of it was.
+        self.windows = {}
+        # (modification time, clock_fit) of each file whose ClockSync
+        #  has been read.
+        self.clock_fits = {}
 
         self.start = None
         self.end = None
@@ -183,23 +223,56 @@ class FitsManager( object ):
         print "Done setting device data."
 
     def load_files( self, files ):
-        new_files = [f for f in files if f not in self.data]
+        """Loads the current time range of the files, reading only the
+         rows in it where the files' clock indices allow."""
+        windows = {}
+        for file in files:
+            if self.start is None or self.end is None:
+                windows[file] = None
+            else:
+                windows[file] = clock_window(self.clock_fit(file),
+                                             self.start, self.end)
+        new_files = [f for f in files
+                     if f not in self.data or self.windows.get(f) != windows[f]]
         print "Loading %d files..." %len(new_files)
+        # Only the channels the devices show are read from each file.
+        columns = dict((name, device.channel_names)
+                       for name, device in DEVICES.iteritems())
         for file in new_files:
-            file_data = fitsio.read_fits(file, primary=False)
+            if windows[file] is None:
+                file_data = fitsio.read_fits(file, primary=False,
+                                             extensions=columns.keys(),
+                                             columns=columns)
+            else:
+                file_data = fitsio.read_clock_range(file, windows[file][0],
+                                                    windows[file][1],
+                                                    extensions=columns.keys(),
+                                                    columns=columns)
             for ext,data in file_data.items():
-                if data is None:
+                if data is None or len(data) == 0:
                     file_data.pop(ext)
                 elif self.averaging:
                     file_data[ext] = mean(data)
             self.data[file] = file_data
+            self.windows[file] = windows[file]
         print "Finished loading."
 
+    def clock_fit( self, file ):
+        """Returns clock_fit(file), reading it again only if the file changed."""
+        mtime = os.path.getmtime(file)
+        if file not in self.clock_fits or self.clock_fits[file][0] != mtime:
+            self.clock_fits[file] = (mtime, clock_fit(file))
+        return self.clock_fits[file][1]
+
     def forget_files( self, files ):
         for file in files:
             self.data.pop(file,None)
+            self.windows.pop(file,None)
     def clear_cache( self ):
         self.data = {}
+        # The computerClock window loaded from each file in self.data,
+        #  or None if all of it was.
+        self.windows = {}
         
     def load_files_and_forget_others( self, files ):
         self.forget_files([f for f in self.data.keys() if f not in files])
@@ -1,18 +1,18 @@
 import optparse
-import glob
 import time
 import struct
+import numpy
 
 import sys,os
 sys.path.append(os.path.join(sys.path[0],'..','communications'))
 from robustness import robustsocket
 sys.path.append(os.path.join(sys.path[0],'..','analysis'))
 import datparsing
-from demodulation import demodulate
+from demodulation import demodulate_revs
 
 usage = """%prog [options] ROOT
 ROOT is the directory containing the directories whose .dat files
-you want to send."""
+you want to send. The newest .dat file is sent as it is written."""
 parser = optparse.OptionParser( usage=usage )
 parser.add_option( '-p', '--port', action='store', type='int',
                    dest='port', default=4578,
@@ -26,35 +26,25 @@ root, port, revs_per_send = args[0], options.port, options.revs_per_send
 
 socket = robustsocket.RobustSocket( port, None )
 
-def send_demod(filename):
-    raw = datparsing.read_raw(filename)
-    for chunk in datparsing.iter_chunks(raw, size=revs_per_send):
-        demod = demodulate(chunk)
-        socket.write(''.join(["$"+struct.pack('f'*49, *row)+"*" for row in demod]))
+def send_demod(raw, starts):
+    # The rows are packed as float32, so demodulate straight to float32.
+    demod = demodulate_revs(raw, starts, counts=True, dtype=numpy.float32)
+    socket.write(''.join(["$"+struct.pack('f'*49, *row)+"*" for row in demod]))
 
-last_sent = None
+tail = datparsing.DatTail(os.path.join(root,'*','*.dat'))
 while True:
-    days = glob.glob(os.path.join(root,'*'))
-    days = filter( (lambda s: os.path.isdir(s)), days )
-    if len(days) > 0:
-        dir = days[-1]
-        dats = glob.glob(os.path.join(dir,'*.dat'))
-        if len(dats) > 1:
-            dat = dats[-2]
-            if dat != last_sent:
-                print "Sending %s"%dat
-                try:
-                    send_demod(dat)
-                    last_sent = dat
-                except Exception as e:
-                    print "ERROR:", e
-                    print "Sleeping"
-                    time.sleep(5)
-            else:
-                print "Already sent %s"%dat
-                print "Sleeping"
-                time.sleep(5)
-        else:
-            print "Not enough .dat files yet."
+    sent = 0
+    try:
+        for raw, starts in tail.iter_new():
+            for i in range(0, len(starts), revs_per_send):
+                send_demod(raw, starts[i:i+revs_per_send])
+            sent += len(starts)
+    except Exception as e:
+        print "ERROR:", e
+    if sent > 0:
+        print "Sent %d revolutions from %s" %(sent, tail.filename)
     else:
-        print "No valid day folder."
+        if tail.filename is None:
+            print "No .dat files yet."
+        print "Sleeping"
+        time.sleep(1)